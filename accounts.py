@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+"""
+Several vk accounts in one process
+
+every Account has own VK_api: connection pools, rate limit bucket of its
+token and long pool loop; long pool responses of all accounts go through
+one EventStream and are handled by a single thread
+"""
+
+import itertools
+import queue
+import threading
+
+TOKENS_FILE = "key.token"
+STREAM_QUEUE = 100  # long pool responses waiting for handling, all accounts
+
+
+def read_tokens(path=TOKENS_FILE):
+    """
+    [(name, token), ...] from file, one account per line: `token` or `name token`
+    accounts without name are numbered from 1
+    """
+    accounts = []
+    with open(path) as f:
+        for line in f:
+            parts = line.split()
+            if not parts:
+                continue
+            if len(parts) == 1:
+                parts.insert(0, str(len(accounts) + 1))
+            accounts.append((parts[0], parts[1]))
+    return accounts
+
+
+class Account:
+    """one vk account, parts are created and used by main"""
+
+    def __init__(self, name, token):
+        self.name = name
+        self.token = token
+        self.vk = None  # VK_api
+        self.status = None  # main.Status
+        self.store = None  # MessageStore, None - no disk cache
+        self.sender = None  # SendQueue
+        self.read_receipts = None  # ReadReceipts
+        self.profiles = None  # ProfileCache, saved to own store
+        self.attachments = None  # AttachmentCache, message ids are per account
+        self.dispatcher = None  # events.Dispatcher, handlers bound to account
+        self.unread = 0  # new incoming messages while account is not shown
+
+    def __repr__(self):
+        return "Account(%r)" % self.name
+
+
+class EventStream:
+    """
+    Merge long pool responses of all accounts into one ordered stream
+
+    long pool threads put(account, res), handle(account, res) is called by
+    one consumer thread in arrival order, so handlers of different accounts
+    never run at the same time and responses of one account keep their order;
+    bounded queue slows long pool threads down if handling can't keep up
+    """
+
+    def __init__(self, handle, on_error=None, size=STREAM_QUEUE):
+        self.handle = handle
+        self.on_error = on_error
+        self.queue = queue.Queue(size)
+        self._seq = itertools.count()
+        self._thread = threading.Thread(target=self._run, name="event-stream")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def put(self, account, res):
+        self.queue.put((next(self._seq), account, res))
+
+    def _run(self):
+        while 1:
+            _, account, res = self.queue.get()
+            try:
+                self.handle(account, res)
+            except Exception as e:
+                if self.on_error:
+                    self.on_error(e)
@@ -0,0 +1,188 @@
+# -*- coding: utf-8 -*-
+"""
+Attachments of messages: keys in Message.attachments, metadata in LRU cache
+
+key is vk attachment string `type{owner_id}_{id}` (photo123_456), attachments
+without id (link, geo) are keyed by type and message id (link@789): their
+metadata is not shared between messages
+"""
+
+import re
+import time
+from collections import OrderedDict
+from threading import Lock
+
+from workers import PREFETCH
+
+ATTACHMENTS_LIMIT = 1000  # metadata entries kept, least recently shown evicted
+GET_BY_ID_LIMIT = 100  # max ids in one messages.getById
+LONG_POOL_ATTACH_LIMIT = 10  # attach1 .. attach10 in long pool $extra
+FAILED_RETRY = 30  # seconds, message whose getById failed is not requested again
+
+_ID = re.compile(r"^-?\d+_\d+$")
+
+
+def attachment_key(attach, m_id):
+    """
+    key of attachment object from api ({'type': 'photo', 'photo': {...}})
+    of message m_id
+    """
+    type_ = attach["type"]
+    obj = attach.get(type_) or {}
+    if "owner_id" in obj and "id" in obj:
+        return "%s%s_%s" % (type_, obj["owner_id"], obj["id"])
+    return "%s@%s" % (type_, m_id)
+
+
+def attachment_type(key):
+    # bare type: key of attachment without id stored before keys had m_id
+    return key.partition("@")[0].rstrip("-_0123456789")
+
+
+def from_long_pool(attachments, m_id):
+    """
+    (sticker id or None, keys) from $attachments of long pool event 4 (mode 2)
+    of message m_id, {'attach1_type': 'photo', 'attach1': '123_456', 'geo': '1'}
+    """
+    keys = []
+    for n in range(1, LONG_POOL_ATTACH_LIMIT + 1):
+        type_ = attachments.get("attach%d_type" % n)
+        if type_ is None:
+            break
+        if type_ == "sticker":  # only sticker and no one else can be in attach
+            return int(attachments["attach%d" % n]), ()
+        value = attachments.get("attach%d" % n, "")
+        keys.append(type_ + value if _ID.match(value) else "%s@%s" % (type_, m_id))
+    if "geo" in attachments:
+        keys.append("geo@%s" % m_id)
+    return None, tuple(keys)
+
+
+def describe(type_, obj):
+    """one line for chat page, obj - metadata of attachment, None if not loaded"""
+    if not obj:
+        return "[%s]" % type_
+    if type_ == "photo":
+        return "[photo] %sx%s %s" % (
+            obj.get("width", "?"),
+            obj.get("height", "?"),
+            obj.get("text", ""),
+        )
+    if type_ == "doc":
+        return "[doc] %s %d KB" % (obj.get("title", ""), obj.get("size", 0) // 1024)
+    if type_ == "audio":
+        return "[audio] %s - %s" % (obj.get("artist", ""), obj.get("title", ""))
+    if type_ == "video":
+        return "[video] %s %ds" % (obj.get("title", ""), obj.get("duration", 0))
+    if type_ == "link":
+        return "[link] %s" % obj.get("url", "")
+    if type_ == "wall":
+        return "[wall] %s" % obj.get("text", "")[:80]
+    return "[%s]" % type_
+
+
+class AttachmentCache:
+    """
+    Metadata of attachments by key, lookups never touch network
+
+    prefetch(messages) is called for messages on screen: attachments of them
+    missing in cache are fetched in background with messages.getById, up to
+    GET_BY_ID_LIMIT messages per call; entries shown least recently are
+    evicted when there are more than `limit`; messages of failed calls are
+    not requested again for `retry` seconds
+
+    fetch(message_ids) -> (success, [message object, ...])
+    submit(priority, func) -> Future, runs func in background
+    on_update() - called after metadata are fetched
+    """
+
+    def __init__(
+        self, fetch, submit, on_update=None, limit=ATTACHMENTS_LIMIT, retry=FAILED_RETRY
+    ):
+        self.fetch = fetch
+        self.submit = submit
+        self.on_update = on_update
+        self.limit = limit
+        self.retry = retry
+        self.entries = OrderedDict()  # key: metadata dict, {} - nothing to show
+        self.pending = {}  # message id: its keys missing in cache
+        self.loading = set()  # message ids in running getById
+        self.failed = {}  # message id: monotonic time of failed getById
+        self.flush_scheduled = False
+        self.lock = Lock()
+
+    def get(self, key):
+        """metadata or None, entry becomes most recently used"""
+        with self.lock:
+            obj = self.entries.get(key)
+            if obj is not None:
+                self.entries.move_to_end(key)
+            return obj
+
+    def put(self, key, obj):
+        with self.lock:
+            self.entries[key] = obj
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.limit:
+                self.entries.popitem(last=False)
+
+    def describe(self, key):
+        return describe(attachment_type(key), self.get(key))
+
+    def prefetch(self, messages):
+        with self.lock:
+            now = time.monotonic()
+            for msg in messages:
+                failed_at = self.failed.get(msg.m_id)
+                if failed_at is not None:
+                    if now - failed_at < self.retry:
+                        continue
+                    del self.failed[msg.m_id]
+                missing = [
+                    key
+                    for key in msg.attachments
+                    if key not in self.entries and key != attachment_type(key)
+                ]
+                if missing and msg.m_id not in self.loading:
+                    self._schedule(msg.m_id, missing)
+
+    def _schedule(self, m_id, keys):
+        # under lock
+        self.pending[m_id] = keys
+        if not self.flush_scheduled:
+            self.flush_scheduled = True
+            self.submit(PREFETCH, self._flush)
+
+    def _flush(self):
+        with self.lock:
+            self.flush_scheduled = False
+            pending, self.pending = self.pending, {}
+            self.loading.update(pending)
+        m_ids = sorted(pending)
+        fetched = False
+        try:
+            for start in range(0, len(m_ids), GET_BY_ID_LIMIT):
+                chunk = m_ids[start : start + GET_BY_ID_LIMIT]
+                success, res = self.fetch(chunk)
+                if not success:
+                    failed_at = time.monotonic()
+                    with self.lock:
+                        self.failed.update(dict.fromkeys(chunk, failed_at))
+                    continue  # requested again when shown after `retry` seconds
+                for e in res:
+                    for attach in e.get("attachments", ()):
+                        self.put(
+                            attachment_key(attach, e["id"]),
+                            attach.get(attach["type"]) or {},
+                        )
+                # deleted messages and media: remember there is nothing to show
+                for m_id in chunk:
+                    for key in pending[m_id]:
+                        if self.get(key) is None:
+                            self.put(key, {})
+                fetched = True
+        finally:
+            with self.lock:
+                self.loading.difference_update(m_ids)
+        if fetched and self.on_update:
+            self.on_update()
@@ -0,0 +1,159 @@
+# -*- coding: utf-8 -*-
+"""
+Local stand-in for vk.com: method api (/method/...) and long pool (/lp)
+
+events are pushed with push(), long pool requests block until there are
+events or `wait` runs out, like the real server
+"""
+
+import json
+import re
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from urllib.parse import parse_qsl, urlparse
+
+LONG_POOL_BATCH = 1000  # max updates in one a_check response
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class FakeVK:
+    def __init__(self, host="127.0.0.1", port=0, dialogs=10, latency=0.0):
+        self.server = _ThreadingHTTPServer((host, port), self._make_handler())
+        self.dialogs = dialogs
+        self.latency = latency  # seconds added to every method call, like network
+        self.updates = []
+        self.cond = threading.Condition()
+        self.ts = 1
+        self.pts = 1
+        self.message_id = 1
+        self.calls = Counter()
+        self.calls_lock = threading.Lock()
+
+    @property
+    def address(self):
+        return "%s:%d" % self.server.server_address
+
+    @property
+    def api_url(self):
+        return "http://%s/method/" % self.address
+
+    def start(self):
+        t = threading.Thread(target=self.server.serve_forever, name="fake-vk")
+        t.daemon = True
+        t.start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def push(self, updates):
+        with self.cond:
+            self.updates.extend(updates)
+            self.cond.notify_all()
+
+    def next_message_id(self):
+        with self.cond:
+            self.message_id += 1
+            return self.message_id
+
+    # long pool
+
+    def a_check(self, params):
+        wait = int(params.get("wait", 25))
+        deadline = time.monotonic() + wait
+        with self.cond:
+            while not self.updates:
+                left = deadline - time.monotonic()
+                if left <= 0:
+                    break
+                self.cond.wait(left)
+            updates = self.updates[:LONG_POOL_BATCH]
+            del self.updates[:LONG_POOL_BATCH]
+            self.ts += 1
+            self.pts += len(updates)
+            return {"ts": self.ts, "pts": self.pts, "updates": updates}
+
+    # method api
+
+    def method(self, name, params):
+        with self.calls_lock:
+            self.calls[name] += 1
+        if name == "execute":
+            # one response per API.method(...) call in code
+            return [
+                self._method_response(inner, {})
+                for inner in re.findall(r"API\.([\w.]+)\(", params.get("code", ""))
+            ]
+        return self._method_response(name, params)
+
+    def _method_response(self, name, params):
+        now = int(time.time())
+        if name == "messages.getLongPollServer":
+            return {
+                "server": "%s/lp" % self.address,
+                "key": "bench",
+                "ts": self.ts,
+                "pts": self.pts,
+            }
+        if name == "users.get":
+            ids = [i for i in params.get("user_ids", "").split(",") if i]
+            users = [{"id": int(i), "first_name": "User", "last_name": i} for i in ids]
+            if "online" in params.get("fields", ""):
+                for user in users:
+                    user["online"] = user["id"] % 2
+                    user["last_seen"] = {"time": now - user["id"], "platform": 7}
+            return users
+        if name == "messages.getConversations":
+            return {
+                "count": self.dialogs,
+                "items": [
+                    {
+                        "conversation": {"peer": {"id": peer_id, "type": "user"}},
+                        "last_message": {"date": now - peer_id, "id": peer_id},
+                    }
+                    for peer_id in range(1, self.dialogs + 1)
+                ],
+                "profiles": [],
+            }
+        if name == "messages.getHistory":
+            return {"count": 0, "items": []}
+        if name == "messages.getLastActivity":
+            return {"online": 0, "time": now}
+        if name == "messages.send":
+            return self.next_message_id()
+        return 1
+
+    def _make_handler(self):
+        vk = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"  # keep-alive, like vk
+
+            def do_GET(self):
+                url = urlparse(self.path)
+                params = dict(parse_qsl(url.query))
+                if url.path == "/lp":
+                    body = vk.a_check(params)
+                elif url.path.startswith("/method/"):
+                    time.sleep(vk.latency)
+                    body = {"response": vk.method(url.path[len("/method/") :], params)}
+                else:
+                    self.send_error(404)
+                    return
+                data = json.dumps(body).encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json; charset=utf-8")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
@@ -0,0 +1,266 @@
+# -*- coding: utf-8 -*-
+"""
+Long pool replay benchmark
+
+runs the app (long pool thread, handlers, redraws, local store) against
+bench.fake_vk and feeds it synthetic or recorded events at a given rate
+
+python -m bench.longpoll_replay --rate 200 --duration 10
+python -m bench.longpoll_replay --replay updates.jsonl --peer 19549540
+
+recorded file - json lines of long pool `updates`, as written by
+`main.py --record FILE`
+
+reports processed events per second, latency from event to painted frame
+(messages of the opened chat), time to handle user input while events
+stream in, api calls per minute and memory growth
+"""
+
+import argparse
+import json
+import re
+import resource
+import threading
+import time
+import tracemalloc
+from collections import deque
+
+import main
+from bench.fake_vk import FakeVK
+from records import Presence
+
+TAG = re.compile(r"\[bench (\d+)\]")
+TICK = 0.005  # producer granularity, seconds
+
+
+def synthetic(peers, watch_peer):
+    """70% messages (half of them to watched chat), 30% presence changes"""
+    seq = 0
+    while 1:
+        seq += 1
+        peer = 1 + seq % peers
+        if seq % 10 < 7:
+            if seq % 2:
+                peer = watch_peer
+            yield [4, 0, 1, peer, int(time.time()), " ... ", "message %d" % seq, {}]
+        else:
+            yield [8 + seq % 2, -peer, 0, int(time.time())]
+
+
+def recorded(path):
+    with open(path) as f:
+        for line in f:
+            for update in json.loads(line):
+                yield update
+
+
+class Latency:
+    """time from event push to first frame that shows it (or a newer one)"""
+
+    def __init__(self):
+        self.pending = deque()  # (seq, pushed_at), seq grows
+        self.samples = []
+        self.lock = threading.Lock()
+
+    def pushed(self, seq):
+        with self.lock:
+            self.pending.append((seq, time.perf_counter()))
+
+    def painted(self, text):
+        seqs = [int(seq) for seq in TAG.findall(text)]
+        if not seqs:
+            return
+        newest = max(seqs)
+        now = time.perf_counter()
+        with self.lock:
+            while self.pending and self.pending[0][0] <= newest:
+                self.samples.append(now - self.pending.popleft()[1])
+
+
+class Producer(threading.Thread):
+    def __init__(self, vk, source, rate, watch_peer, latency):
+        super().__init__(name="bench-producer")
+        self.daemon = True
+        self.vk = vk
+        self.source = source
+        self.rate = rate
+        self.watch_peer = watch_peer
+        self.latency = latency
+        self.sent = 0
+        self.stopped = threading.Event()
+
+    def _tag(self, update):
+        update = list(update)
+        if update[0] == 4:
+            update[1] = self.vk.next_message_id()
+            update[6] = "%s [bench %d]" % (update[6], self.sent)
+            if update[3] == self.watch_peer:
+                self.latency.pushed(self.sent)
+        return update
+
+    def run(self):
+        start = time.perf_counter()
+        while not self.stopped.is_set():
+            due = int((time.perf_counter() - start) * self.rate) - self.sent
+            if due <= 0:  # ahead of rate, nothing to push in this tick
+                time.sleep(TICK)
+                continue
+            batch = []
+            for update in self.source:
+                self.sent += 1
+                batch.append(self._tag(update))
+                if len(batch) >= due:
+                    break
+            if not batch:
+                return  # recorded stream is over
+            self.vk.push(batch)
+            time.sleep(TICK)
+
+
+class InputProbe(threading.Thread):
+    """user typing `rate` commands per second, time of handle_query each"""
+
+    def __init__(self, rate, query="3"):  # chat page: newer, no-op in live view
+        super().__init__(name="bench-input")
+        self.daemon = True
+        self.rate = rate
+        self.query = query
+        self.samples = []
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(1 / self.rate):
+            start = time.perf_counter()
+            main.handle_query(self.query)
+            self.samples.append(time.perf_counter() - start)
+
+
+class _Sink:
+    def write(self, data):
+        return len(data)
+
+    def flush(self):
+        pass
+
+
+def percentile(samples, p):
+    if not samples:
+        return float("nan")
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(len(samples) * p / 100))]
+
+
+def rss_kb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def run(args):
+    fake = FakeVK(dialogs=args.peers)
+    fake.start()
+
+    account = main.make_account(
+        "bench",
+        "bench",
+        None if args.no_store else ":memory:",
+        api_url=fake.api_url,
+        long_pool_scheme="http",
+    )
+    main.use_account(account)  # loads dialogs
+    main.GLOBAL_SCREEN.out = _Sink()
+    main.GLOBAL_SCREEN.clear = lambda: None
+
+    latency = Latency()
+    paint = main.GLOBAL_SCREEN.paint
+
+    def measured_paint(text):
+        paint(text)
+        latency.painted(text)
+
+    main.GLOBAL_SCREEN.paint = measured_paint
+
+    processed = [0]
+    handle = main.handle_long_pool_response
+
+    def counted_handle(account, res):
+        handle(account, res)
+        processed[0] += len(res["updates"])
+
+    main.handle_long_pool_response = counted_handle
+
+    main.GLOBAL_STATUS.is_online.set(args.peer, Presence(0, 0))
+    main.GLOBAL_STATE.set(state=main.StateType.CHAT_PAGE, args=(args.peer,))
+
+    if args.tracemalloc:
+        tracemalloc.start()
+    rss_before = rss_kb()
+    source = recorded(args.replay) if args.replay else synthetic(args.peers, args.peer)
+    producer = Producer(fake, source, args.rate, args.peer, latency)
+    probe = InputProbe(args.input_rate)
+    main.start_long_pool()
+    started = time.perf_counter()
+    producer.start()
+    if args.input_rate:
+        probe.start()
+    producer.join(args.duration)
+    producer.stopped.set()
+    probe.stopped.set()
+    # let the app drain what was pushed
+    drain_until = time.perf_counter() + args.drain
+    while processed[0] < producer.sent and time.perf_counter() < drain_until:
+        time.sleep(0.05)
+    elapsed = time.perf_counter() - started
+
+    calls = sum(fake.calls.values())
+    print("events: pushed %d, processed %d" % (producer.sent, processed[0]))
+    print(
+        "throughput: %.1f events/s (offered %.1f)"
+        % (processed[0] / elapsed, producer.sent / elapsed)
+    )
+    print(
+        "event -> screen, ms: p50 %.1f  p95 %.1f  p99 %.1f  max %.1f  (%d samples)"
+        % (
+            percentile(latency.samples, 50) * 1000,
+            percentile(latency.samples, 95) * 1000,
+            percentile(latency.samples, 99) * 1000,
+            max(latency.samples or [float("nan")]) * 1000,
+            len(latency.samples),
+        )
+    )
+    print(
+        "input -> handled, ms: p50 %.1f  p95 %.1f  p99 %.1f  max %.1f  (%d samples)"
+        % (
+            percentile(probe.samples, 50) * 1000,
+            percentile(probe.samples, 95) * 1000,
+            percentile(probe.samples, 99) * 1000,
+            max(probe.samples or [float("nan")]) * 1000,
+            len(probe.samples),
+        )
+    )
+    print("api calls: %.1f per minute" % (calls / elapsed * 60))
+    for method, count in fake.calls.most_common():
+        print("    %-30s %d" % (method, count))
+    print("memory: max rss +%d KB" % (rss_kb() - rss_before))
+    if args.tracemalloc:
+        current, peak = tracemalloc.get_traced_memory()
+        print("memory: python heap %d KB, peak %d KB" % (current // 1024, peak // 1024))
+    fake.stop()
+
+
+def main_():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    parser.add_argument("--rate", type=float, default=100, help="events per second")
+    parser.add_argument("--duration", type=float, default=10, help="seconds")
+    parser.add_argument("--drain", type=float, default=5, help="seconds to finish")
+    parser.add_argument("--peers", type=int, default=50, help="synthetic dialogs")
+    parser.add_argument("--peer", type=int, default=1, help="opened chat")
+    parser.add_argument(
+        "--input-rate", type=float, default=10, help="user commands per second"
+    )
+    parser.add_argument("--replay", help="recorded updates, json lines")
+    parser.add_argument("--no-store", action="store_true", help="skip sqlite")
+    parser.add_argument("--tracemalloc", action="store_true")
+    run(parser.parse_args())
+
+
+if __name__ == "__main__":
+    main_()
@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+"""
+Startup benchmark: time to first frame and to long pool connection
+
+python -m bench.startup --latency 0.2 --dialogs 200 --runs 5
+
+every run starts a fresh interpreter (imports are measured too) in a temp
+dir with messages.db filled for `dialogs` peers, vk is bench.fake_vk with
+`latency` seconds added to every api call
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+from bench.fake_vk import FakeVK
+
+CONNECT_TIMEOUT = 10  # seconds to wait for long pool in child
+
+
+def child(api_url, workdir):
+    import main  # first, STARTED is set by this import
+
+    class Sink:
+        def write(self, data):
+            return len(data)
+
+        def flush(self):
+            pass
+
+    os.chdir(workdir)
+    main.GLOBAL_SCREEN.out = Sink()
+    main.GLOBAL_SCREEN.clear = lambda: None
+    account = main.make_account(
+        "bench", "bench", api_url=api_url, long_pool_scheme="http"
+    )
+    main.use_account(account)
+    main.draw_page()
+    main.start_long_pool()
+    deadline = time.monotonic() + CONNECT_TIMEOUT
+    while time.monotonic() < deadline:
+        if "startup_long_pool_seconds" in main.GLOBAL_METRICS.histograms:
+            break
+        time.sleep(0.005)
+    histograms = main.GLOBAL_METRICS.snapshot()["histograms"]
+    print(
+        json.dumps(
+            {
+                "first_paint": main.GLOBAL_FIRST_PAINT,
+                "long_pool": histograms.get("startup_long_pool_seconds", {})
+                .get("", {})
+                .get("max"),
+                "dialogs_on_screen": len(account.status.dialogs),
+            }
+        )
+    )
+    sys.stdout.flush()
+    os._exit(0)  # daemon threads, no cleanup needed
+
+
+def fill_store(path, dialogs):
+    from records import Message
+    from storage import MessageStore
+
+    store = MessageStore(path)
+    now = int(time.time())
+    for peer_id in range(1, dialogs + 1):
+        store.save_messages(
+            peer_id,
+            [
+                Message(peer_id * 100 + i, i % 2, now - peer_id, "cached")
+                for i in range(10)
+            ],
+        )
+    store.close()
+
+
+def run(args):
+    fake = FakeVK(dialogs=args.dialogs, latency=args.latency)
+    fake.start()
+    workdir = tempfile.mkdtemp(prefix="vk-startup-")
+    fill_store(os.path.join(workdir, "messages.db"), args.dialogs)
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    results = []
+    for _ in range(args.runs):
+        started = time.perf_counter()
+        out = subprocess.check_output(
+            [sys.executable, "-m", "bench.startup", "--child", fake.api_url, workdir],
+            cwd=root,
+        )
+        wall = time.perf_counter() - started
+        res = json.loads(out.decode("utf-8").strip().splitlines()[-1])
+        res["process"] = wall
+        results.append(res)
+    fake.stop()
+
+    def row(name, key):
+        values = sorted(r[key] for r in results if r[key] is not None)
+        if not values:
+            print("%-34s -" % name)
+            return
+        print(
+            "%-34s min %.3f  median %.3f  max %.3f"
+            % (name, values[0], values[len(values) // 2], values[-1])
+        )
+
+    print("runs: %d, api latency %.3f s" % (args.runs, args.latency))
+    row("first frame (from import main), s", "first_paint")
+    row("long pool connected, s", "long_pool")
+    row("whole child process, s", "process")
+    print("dialogs on first frame: %d" % results[-1]["dialogs_on_screen"])
+    import main
+
+    print("target for first frame: %.3f s" % main.FIRST_PAINT_TARGET)
+
+
+def main_():
+    if sys.argv[1:2] == ["--child"]:
+        return child(sys.argv[2], sys.argv[3])
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    parser.add_argument("--latency", type=float, default=0.2, help="seconds")
+    parser.add_argument("--dialogs", type=int, default=200)
+    parser.add_argument("--runs", type=int, default=5)
+    run(parser.parse_args())
+
+
+if __name__ == "__main__":
+    main_()
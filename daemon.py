@@ -0,0 +1,196 @@
+# -*- coding: utf-8 -*-
+"""
+Headless mode api: unix socket, one json object per line
+
+request:  {"id": 1, "method": "send", "params": {"peer_id": 1, "text": "hi"}}
+response: {"id": 1, "result": ...} or {"id": 1, "error": "..."}
+
+{"method": "subscribe", "params": {"types": ["MESSAGE", "SET_ONLINE"]}}
+streams long pool events to the connection after the response:
+{"event": {"type": "MESSAGE", "message_id": 1, ...}}
+{"dropped": 12} - client was too slow, that many events were skipped
+"""
+
+import json
+import os
+import queue
+import socket
+import socketserver
+import threading
+
+SOCKET_PATH = "vk-console-chat.sock"
+SUBSCRIBER_QUEUE = 1000  # events buffered per slow client before dropping
+
+
+def event_to_dict(event):
+    res = event._asdict()
+    res["type"] = event.type.name
+    return res
+
+
+class Subscription:
+    def __init__(self, types=None, size=SUBSCRIBER_QUEUE):
+        self.types = set(types) if types else None
+        self.queue = queue.Queue(size)
+        self.dropped = 0
+        self.closed = False
+
+    def close(self):
+        """stop writer, never blocks: an event is dropped if queue is full"""
+        self.closed = True
+        while 1:
+            try:
+                self.queue.put_nowait(None)
+                return
+            except queue.Full:
+                try:
+                    self.queue.get_nowait()
+                except queue.Empty:
+                    pass
+
+
+class EventHub:
+    """fan out long pool events to subscribed clients, never blocks publisher"""
+
+    def __init__(self):
+        self.subscriptions = set()
+        self.lock = threading.Lock()
+
+    def subscribe(self, types=None):
+        sub = Subscription(types)
+        with self.lock:
+            self.subscriptions.add(sub)
+        return sub
+
+    def unsubscribe(self, sub):
+        with self.lock:
+            self.subscriptions.discard(sub)
+        sub.close()
+
+    def publish(self, event, account=None):
+        """long pool handler, gets typed event, account name is added to it"""
+        with self.lock:
+            subscriptions = list(self.subscriptions)
+        if not subscriptions:
+            return
+        name = event.type.name
+        payload = None
+        for sub in subscriptions:
+            if sub.types is not None and name not in sub.types:
+                continue
+            if payload is None:
+                payload = event_to_dict(event)
+                if account is not None:
+                    payload["account"] = account
+            try:
+                sub.queue.put_nowait(payload)
+            except queue.Full:
+                sub.dropped += 1
+
+
+class _Handler(socketserver.StreamRequestHandler):
+    def setup(self):
+        super().setup()
+        self.write_lock = threading.Lock()
+        self.subscription = None
+
+    def send(self, obj):
+        data = (json.dumps(obj, ensure_ascii=False) + "\n").encode("utf-8")
+        with self.write_lock:
+            self.wfile.write(data)
+            self.wfile.flush()
+
+    def handle(self):
+        for line in self.rfile:
+            if not line.strip():
+                continue
+            try:
+                request = json.loads(line.decode("utf-8"))
+                method = request.get("method")
+                params = request.get("params") or {}
+            except (ValueError, AttributeError):
+                self.send({"id": None, "error": "bad request"})
+                continue
+            response = {"id": request.get("id")}
+            try:
+                if method == "subscribe":
+                    response["result"] = self.subscribe(params.get("types"))
+                elif method in self.server.methods:
+                    response["result"] = self.server.methods[method](**params)
+                else:
+                    response["error"] = "unknown method: %s" % method
+            except Exception as e:
+                response["error"] = "%s: %s" % (e.__class__.__name__, e)
+            try:
+                self.send(response)
+            except OSError:
+                break
+
+    def subscribe(self, types):
+        if self.subscription is not None:
+            self.server.hub.unsubscribe(self.subscription)
+        self.subscription = self.server.hub.subscribe(types)
+        t = threading.Thread(
+            target=self.stream, args=(self.subscription,), name="api-stream"
+        )
+        t.daemon = True
+        t.start()
+        return True
+
+    def stream(self, sub):
+        while 1:
+            payload = sub.queue.get()
+            if payload is None or sub.closed:
+                return
+            try:
+                if sub.dropped:
+                    dropped, sub.dropped = sub.dropped, 0
+                    self.send({"dropped": dropped})
+                self.send({"event": payload})
+            except (OSError, ValueError):  # client gone, file closed
+                self.server.hub.unsubscribe(sub)
+                return
+
+    def finish(self):
+        if self.subscription is not None:
+            self.server.hub.unsubscribe(self.subscription)
+        super().finish()
+
+
+class ApiServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """
+    methods: {name: func(**params) -> json-serializable result}
+    hub: EventHub for `subscribe`
+    socket file is readable only by owner, it gives full access to account
+    """
+
+    daemon_threads = True
+
+    def __init__(self, path, methods, hub):
+        self.methods = methods
+        self.hub = hub
+        self.path = path
+        if os.path.exists(path):
+            self._remove_stale(path)
+        old_umask = os.umask(0o177)
+        try:
+            super().__init__(path, _Handler)
+        finally:
+            os.umask(old_umask)
+
+    @staticmethod
+    def _remove_stale(path):
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            probe.connect(path)
+        except OSError:  # nobody listens, left after crash
+            os.unlink(path)
+            return
+        finally:
+            probe.close()
+        raise RuntimeError("another daemon is listening on %s" % path)
+
+    def server_close(self):
+        super().server_close()
+        if os.path.exists(self.path):
+            os.unlink(self.path)
@@ -0,0 +1,51 @@
+# -*- coding: utf-8 -*-
+from bisect import bisect_left, insort
+from threading import Lock
+
+
+class DialogIndex:
+    """
+    Conversations ordered by last message time, newest first
+
+    `keys` is a sorted list of (-timestamp, peer_id), position of a peer is
+    found by bisect in O(log n) comparisons; update is still O(n): insert and
+    delete in the list shift its tail (one memmove, fast for thousands of
+    dialogs), but no event rescans or re-sorts the list
+    """
+
+    def __init__(self):
+        self.keys = []
+        self.timestamps = {}  # peer_id: last message timestamp
+        self.lock = Lock()
+
+    def __len__(self):
+        return len(self.keys)
+
+    def __contains__(self, peer_id):
+        return peer_id in self.timestamps
+
+    def update(self, peer_id, timestamp):
+        """add peer or move it to position of its new last message"""
+        with self.lock:
+            old = self.timestamps.get(peer_id)
+            if old is not None:
+                if old >= timestamp:
+                    return
+                del self.keys[bisect_left(self.keys, (-old, peer_id))]
+            self.timestamps[peer_id] = timestamp
+            insort(self.keys, (-timestamp, peer_id))
+
+    def remove(self, peer_id):
+        with self.lock:
+            old = self.timestamps.pop(peer_id, None)
+            if old is not None:
+                del self.keys[bisect_left(self.keys, (-old, peer_id))]
+
+    def page(self, offset, count):
+        """peer ids of dialogs [offset, offset + count)"""
+        with self.lock:
+            return [peer_id for _, peer_id in self.keys[offset : offset + count]]
+
+    def index(self, peer_id):
+        with self.lock:
+            return bisect_left(self.keys, (-self.timestamps[peer_id], peer_id))
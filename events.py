@@ -0,0 +1,155 @@
+# -*- coding: utf-8 -*-
+"""
+Long pool updates -> typed events
+
+https://vk.com/dev/using_longpoll (mode 2 + 32 + 64, no version)
+"""
+
+import html
+from collections import namedtuple
+from enum import Enum
+
+# message flags
+UNREAD = 1
+OUTBOX = 2
+DELETED = 128
+
+CHAT_PEER_OFFSET = 2000000000
+
+
+class EventType(Enum):
+    MESSAGE_FLAGS_REPLACE = 1
+    MESSAGE_FLAGS_SET = 2
+    MESSAGE_FLAGS_RESET = 3
+    MESSAGE = 4
+    MESSAGE_EDIT = 5
+    READ_INBOX = 6
+    READ_OUTBOX = 7
+    SET_ONLINE = 8
+    SET_OFFLINE = 9
+    DIALOG_FLAGS_RESET = 10
+    DIALOG_FLAGS_REPLACE = 11
+    DIALOG_FLAGS_SET = 12
+    HISTORY_DELETE = 13
+    HISTORY_RESTORE = 14
+    CHAT_CHANGED = 51
+    CHAT_INFO_CHANGED = 52
+    TYPING = 61
+    TYPING_IN_CHAT = 62
+    CALL = 70
+    UNREAD_COUNTER = 80
+    NOTIFY_SETTINGS = 114
+
+
+MessageFlags = namedtuple("MessageFlags", "type message_id flags peer_id")
+NewMessage = namedtuple(
+    "NewMessage", "type message_id flags peer_id timestamp title text attachments"
+)
+MessageEdit = namedtuple(
+    "MessageEdit", "type message_id mask peer_id timestamp text attachments"
+)
+ReadUpTo = namedtuple("ReadUpTo", "type peer_id local_id")
+PresenceChange = namedtuple("PresenceChange", "type user_id extra timestamp")
+DialogFlags = namedtuple("DialogFlags", "type peer_id flags")
+HistoryRange = namedtuple("HistoryRange", "type peer_id local_id")
+ChatChanged = namedtuple("ChatChanged", "type chat_id self")
+ChatInfoChanged = namedtuple("ChatInfoChanged", "type type_id peer_id info")
+Typing = namedtuple("Typing", "type user_id peer_id")
+Call = namedtuple("Call", "type user_id call_id")
+UnreadCounter = namedtuple("UnreadCounter", "type count")
+NotifySettings = namedtuple("NotifySettings", "type peer_id sound disabled_until")
+
+
+def _at(u, i, default=None):
+    return u[i] if len(u) > i else default
+
+
+# code: (EventType, raw update -> event), texts are unescaped later for whole batch
+_DECODERS = {
+    1: lambda t, u: MessageFlags(t, u[1], u[2], _at(u, 3)),
+    2: lambda t, u: MessageFlags(t, u[1], u[2], _at(u, 3)),
+    3: lambda t, u: MessageFlags(t, u[1], u[2], _at(u, 3)),
+    4: lambda t, u: NewMessage(
+        t, u[1], u[2], u[3], u[4], _at(u, 5, ""), _at(u, 6, ""), _at(u, 7, {})
+    ),
+    5: lambda t, u: MessageEdit(
+        t, u[1], u[2], u[3], u[4], _at(u, 5, ""), _at(u, 6, {})
+    ),
+    6: lambda t, u: ReadUpTo(t, u[1], u[2]),
+    7: lambda t, u: ReadUpTo(t, u[1], u[2]),
+    8: lambda t, u: PresenceChange(t, -u[1], u[2], u[3]),
+    9: lambda t, u: PresenceChange(t, -u[1], u[2], u[3]),
+    10: lambda t, u: DialogFlags(t, u[1], u[2]),
+    11: lambda t, u: DialogFlags(t, u[1], u[2]),
+    12: lambda t, u: DialogFlags(t, u[1], u[2]),
+    13: lambda t, u: HistoryRange(t, u[1], u[2]),
+    14: lambda t, u: HistoryRange(t, u[1], u[2]),
+    51: lambda t, u: ChatChanged(t, u[1], _at(u, 2, 0)),
+    52: lambda t, u: ChatInfoChanged(t, u[1], u[2], _at(u, 3)),
+    61: lambda t, u: Typing(t, u[1], u[1]),
+    62: lambda t, u: Typing(t, u[1], CHAT_PEER_OFFSET + u[2]),
+    70: lambda t, u: Call(t, u[1], u[2]),
+    80: lambda t, u: UnreadCounter(t, u[1]),
+    114: lambda t, u: NotifySettings(
+        t, u[1]["peer_id"], u[1].get("sound"), u[1].get("disabled_until")
+    ),
+}
+DECODERS = {code: (EventType(code), decoder) for code, decoder in _DECODERS.items()}
+
+_SEPARATOR = "\x00"  # not produced by html.unescape and not sent by vk
+
+
+def _unescape_texts(texts):
+    """html.unescape + <br> for a list of texts, in one call for whole batch"""
+    if not any("&" in text or "<br>" in text for text in texts):
+        return texts
+    joined = html.unescape(_SEPARATOR.join(texts)).replace("<br>", "\n")
+    return joined.split(_SEPARATOR)
+
+
+def decode_updates(updates):
+    """
+    raw `updates` of long pool response -> list of typed events
+    unknown codes are dropped, texts of messages and edits are unescaped
+    """
+    events = []
+    with_text = []
+    get = DECODERS.get
+    for u in updates:
+        entry = get(u[0])
+        if entry is None:
+            continue
+        event = entry[1](entry[0], u)
+        if entry[0] is EventType.MESSAGE or entry[0] is EventType.MESSAGE_EDIT:
+            with_text.append(len(events))
+        events.append(event)
+    if with_text:
+        texts = _unescape_texts([events[i].text for i in with_text])
+        for i, text in zip(with_text, texts):
+            events[i] = events[i]._replace(text=text)
+    return events
+
+
+class Dispatcher:
+    """
+    Precomputed EventType -> handlers table
+
+    notify_on: {EventType: [handler, ...]}, handler gets typed event
+    """
+
+    def __init__(self, notify_on):
+        self.table = {
+            event_type: tuple(handlers) for event_type, handlers in notify_on.items()
+        }
+
+    def dispatch(self, events):
+        """call handlers, return True if any event had handlers"""
+        handled = False
+        get = self.table.get
+        for event in events:
+            handlers = get(event.type)
+            if handlers:
+                for handler in handlers:
+                    handler(event)
+                handled = True
+        return handled
@@ -0,0 +1,157 @@
+# -*- coding: utf-8 -*-
+from threading import RLock
+
+from workers import FOREGROUND, PREFETCH
+
+PAGE_SIZE = 10
+WINDOW_LIMIT = 200  # max messages of one chat kept while scrolling
+
+
+class Scrollback:
+    """
+    Bounded window over history of one chat, scrolled by pages
+
+    window is chronological, `pos` - how many messages of window are below
+    the visible page; pages are loaded by message id, so new messages in the
+    chat do not shift them
+
+    fetch_older(m_id, count) / fetch_newer(m_id, count) - chronological list
+    of messages older/newer than m_id (m_id None - the newest ones),
+    None on error; they run in `submit(priority, func, *args)` -> Future
+    on_update() is called when a page arrives
+    """
+
+    def __init__(
+        self,
+        messages,
+        fetch_older,
+        fetch_newer,
+        submit,
+        on_update,
+        page_size=PAGE_SIZE,
+        window_limit=WINDOW_LIMIT,
+    ):
+        self.window = list(messages)
+        self.fetch_older = fetch_older
+        self.fetch_newer = fetch_newer
+        self.submit = submit
+        self.on_update = on_update
+        self.page_size = page_size
+        self.window_limit = window_limit
+        self.pos = 0
+        self.exhausted = False  # first message of chat is in window
+        self.live = True  # last message of window is the last one of chat
+        self.older_future = None
+        self.newer_future = None
+        self.advance = False  # user waits for newer page, show it when loaded
+        # reentrant: done callback runs in place if future is already done
+        self.lock = RLock()
+
+    @property
+    def at_live(self):
+        """nothing is scrolled, live view should be shown"""
+        return self.live and self.pos == 0
+
+    @property
+    def loading(self):
+        return self.older_future is not None or self.newer_future is not None
+
+    def page(self):
+        with self.lock:
+            end = max(0, len(self.window) - self.pos)
+            return self.window[max(0, end - self.page_size) : end]
+
+    def older(self):
+        with self.lock:
+            if self.exhausted and len(self.window) - self.pos <= self.page_size:
+                return  # already on the first page
+            self.pos += self.page_size
+            if len(self.window) - self.pos < self.page_size and not self.exhausted:
+                self._load_older(FOREGROUND)
+            self._prefetch_older()
+
+    def newer(self):
+        with self.lock:
+            if self.pos == 0 and not self.live:
+                self.advance = True
+                self._load_newer(FOREGROUND)
+                return
+            self.pos = max(0, self.pos - self.page_size)
+            if not self.live and self.pos < self.page_size:
+                self._load_newer(PREFETCH)
+
+    def _prefetch_older(self):
+        # keep one page above the visible one ready
+        if (
+            not self.exhausted
+            and len(self.window) - self.pos < 2 * self.page_size
+            and self.older_future is None
+        ):
+            self._load_older(PREFETCH)
+
+    def _load_older(self, priority):
+        if self.older_future is not None:
+            return
+        anchor = self.window[0].m_id if self.window else None
+        self.older_future = self.submit(
+            priority, self.fetch_older, anchor, self.page_size
+        )
+        self.older_future.add_done_callback(
+            lambda future: self._older_done(anchor, future)
+        )
+
+    def _load_newer(self, priority):
+        if self.newer_future is not None or not self.window:
+            return
+        anchor = self.window[-1].m_id
+        self.newer_future = self.submit(
+            priority, self.fetch_newer, anchor, self.page_size
+        )
+        self.newer_future.add_done_callback(
+            lambda future: self._newer_done(anchor, future)
+        )
+
+    def _older_done(self, anchor, future):
+        with self.lock:
+            self.older_future = None
+            items = None if future.exception() else future.result()
+            first = self.window[0].m_id if self.window else None
+            if items is None or first != anchor:
+                return
+            if anchor is not None:
+                items = [msg for msg in items if msg.m_id < anchor]
+            self.window[0:0] = items
+            if len(items) < self.page_size:
+                self.exhausted = True
+            # too long - drop newest messages, but not visible ones
+            drop = min(len(self.window) - self.window_limit, self.pos)
+            if drop > 0:
+                del self.window[-drop:]
+                self.pos -= drop
+                self.live = False
+            self._prefetch_older()
+        self.on_update()
+
+    def _newer_done(self, anchor, future):
+        with self.lock:
+            self.newer_future = None
+            items = None if future.exception() else future.result()
+            last = self.window[-1].m_id if self.window else None
+            if items is None or last != anchor:
+                return
+            items = [msg for msg in items if msg.m_id > anchor]
+            self.window.extend(items)
+            if not self.advance:
+                self.pos += len(items)  # visible page stays in place
+            self.advance = False
+            if len(items) < self.page_size:
+                self.live = True
+            # too long - drop oldest messages, but not visible ones
+            drop = min(
+                len(self.window) - self.window_limit,
+                len(self.window) - self.pos - self.page_size,
+            )
+            if drop > 0:
+                del self.window[:drop]
+                self.exhausted = False
+        self.on_update()
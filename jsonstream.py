@@ -0,0 +1,117 @@
+# -*- coding: utf-8 -*-
+"""
+Json of api responses parsed straight from bytes
+
+orjson (whole documents) and ijson (arrays parsed item by item while they are
+read from network) are used when installed, json module otherwise
+"""
+
+import json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+try:
+    import ijson
+except ImportError:
+    ijson = None
+
+STREAMING = ijson is not None  # parse_items reads file lazily
+
+
+def loads(data):
+    """object from bytes (or str), bytes are not decoded to str first"""
+    if orjson is not None:
+        return orjson.loads(data)  # JSONDecodeError is ValueError
+    return json.loads(data)
+
+
+def parse_items(source, path):
+    """
+    (document, items iterator) for array at dotted `path` of json document,
+    the array is left empty in document; source is bytes or file with read()
+
+    with ijson, document is complete up to the array at once and the rest of
+    it after items are exhausted; without it whole document is parsed here
+    """
+    if STREAMING and hasattr(source, "read"):
+        return _stream(source, path)
+    if hasattr(source, "read"):
+        source = source.read()
+    return _split(loads(source), path)
+
+
+def _split(doc, path):
+    parent = doc
+    keys = path.split(".")
+    for key in keys[:-1]:
+        parent = parent.get(key) if isinstance(parent, dict) else None
+    if not isinstance(parent, dict) or not isinstance(parent.get(keys[-1]), list):
+        return doc, iter(())
+    items, parent[keys[-1]] = parent[keys[-1]], []
+    return doc, iter(items)
+
+
+def _stream(fp, path):
+    events = ijson.parse(fp, use_float=True)
+    doc = ijson.ObjectBuilder()
+    for prefix, event, value in events:
+        doc.event(event, value)
+        if prefix == path and event == "start_array":
+            break
+    return doc.value, _items(events, doc, path)
+
+
+def _items(events, doc, path):
+    item = None
+    depth = 0
+    for prefix, event, value in events:
+        if item is None:
+            if prefix == path and event == "end_array":
+                doc.event(event, value)
+                break
+            item = ijson.ObjectBuilder()
+        item.event(event, value)
+        if event in ("start_map", "start_array"):
+            depth += 1
+        elif event in ("end_map", "end_array"):
+            depth -= 1
+        if depth == 0:
+            yield item.value
+            item = None
+    for prefix, event, value in events:  # fields after the array
+        doc.event(event, value)
+
+
+class ItemStream:
+    """
+    Items of response array, each parsed when iteration reaches it
+
+    for item in stream: ...  - once, the stream can't be restarted
+    stream.rest - response without the array, complete after iteration
+    close() - release connection without reading the rest
+    """
+
+    def __init__(self, items, rest, close=None):
+        self._items = items
+        self.rest = rest
+        self._close = close
+
+    def __iter__(self):
+        try:
+            for item in self._items:
+                yield item
+        finally:
+            self.close()
+
+    def close(self):
+        if self._close is not None:
+            close, self._close = self._close, None
+            close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
@@ -1,29 +1,86 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
+from time import perf_counter
 
-import html  # unescape
+STARTED = perf_counter()  # before imports, for time to first paint
+
+import io
 import itertools
+import json
 import os
 import sys  # sys.stdin.read, argv
-from collections import deque
+from collections import Counter, deque, namedtuple
+from contextlib import redirect_stdout
+from functools import partial
 from datetime import datetime
 from enum import Enum
 from threading import Lock, Thread, current_thread
-from time import sleep
-
-import click  # edit
-
+from time import monotonic, sleep
+
+from accounts import Account, EventStream, read_tokens
+from attachments import AttachmentCache, from_long_pool
+from daemon import SOCKET_PATH, ApiServer, EventHub
+from dialogs import DialogIndex
+from events import (
+    DELETED,
+    OUTBOX,
+    UNREAD,
+    Dispatcher,
+    EventType,
+    MessageEdit,
+    MessageFlags,
+    NewMessage,
+    PresenceChange,
+    ReadUpTo,
+    Typing,
+    decode_updates,
+)
+from history import Scrollback
+from metrics import JsonDumper, Metrics, TimedLock, serve
+from presence import PRESENCE_FIELDS, PresenceTracker
+from profiles import ProfileCache
+from read_receipts import ReadReceipts
+from records import Message, Presence, User
+from send_queue import SendQueue
+from snapshot import Published
+from render import RedrawScheduler, Screen
+from storage import SEARCH_LIMIT, STORE_PATH, MessageStore
 from vk_api import VK_api
+from workers import FOREGROUND, PREFETCH, WorkerPool
 
 MESSAGES_LIMIT = 10
 ERRORS_LIMIT = 5
 
-WATCH_ON = [1,2,3]  # list of id here
-
+# 2 - receive attachments
+# 32 - receive pts, cursor for getLongPollHistory
+# 64 - receive $extra fields in SET_ONLINE
+LONG_POOL_MODE = 2 + 32 + 64
+DIALOGS_PAGE = 200  # max count of messages.getConversations
+DIALOGS_ON_SCREEN = 10
+TYPING_SHOWN = 6  # seconds, vk sends typing event every 5 seconds
+FIRST_PAINT_TARGET = 0.3  # seconds from start, slower start is reported as error
+
+GLOBAL_ACCOUNTS = []
+GLOBAL_ACCOUNT = None  # shown one, GLOBAL_VK, _STATUS, _STORE, _SENDER are its parts
+GLOBAL_STREAM = None  # EventStream of all accounts
 GLOBAL_VK = None
+GLOBAL_STORE = None
+GLOBAL_SENDER = None
+GLOBAL_READ_RECEIPTS = None
+GLOBAL_PROFILES = None  # ProfileCache of shown account
+GLOBAL_ATTACHMENTS = None  # AttachmentCache of shown account
+GLOBAL_RECORD = None  # --record FILE, long pool updates as json lines
+GLOBAL_HEADLESS = False  # --daemon, nothing is drawn
+GLOBAL_FIRST_PAINT = None  # seconds from start to first painted frame
 
 GLOBAL_ERRORS = deque(maxlen=ERRORS_LIMIT)
 
+GLOBAL_METRICS = Metrics()
+
+GLOBAL_WORKERS = WorkerPool()
+GLOBAL_METRICS.gauge("workers_queue_depth", lambda: GLOBAL_WORKERS.queue_depth)
+GLOBAL_METRICS.gauge("workers_in_flight", lambda: GLOBAL_WORKERS.in_flight)
+
 
 def log_error(e):
     GLOBAL_ERRORS.append((datetime.now().strftime("%H:%M:%S"), e))
@@ -34,64 +91,57 @@ class StateType(Enum):
     CHAT_PAGE = 2
     CHAT_WRITE_MESSAGE_PAGE = 3
     CHAT_SEND_MESSAGE_PAGE = 4
-
-
-class EventType(Enum):
-    MESSAGE = 4
-    SET_ONLINE = 8
-    SET_OFFLINE = 9
+    SEARCH_PAGE = 5
 
 
 # https://stackoverflow.com/questions/30239092/how-to-get-multiline-input-from-user
 
 
-class Status:
-    messages = {}
-    """
-    {
-        uid:{
-            'm_id':_,
-            'out':_,
-            'timestamp':_,
-            'title':_,
-            'body':_,
-            'read_state':_ ?
-        }
-    }
+class Status(Published):
     """
-    is_online = {}
-    """
-    {
-        uid:{
-            'status':_,
-            'timestamp':_
-        }
-    }
+    State of one account
+    messages, titles, typing and dialogs_count are in `snapshot`: immutable,
+    read without locks, changed only inside `with status.writing() as draft:`
+    presence and dialogs order are kept by own thread-safe indexes
     """
-    users_write_mutex = Lock()
-    users = deque(WATCH_ON, maxlen=10)  # TODO: add update dialog-list
-    """
-    [
-        {
-            id:id:_,
-            first_name:_,
-            last_name:_,
-        }
 
-        or
+    def __init__(self, fetch_presence=None):
+        # own containers, one Status per account
+        # fetch_presence(ids) -> users.get with online fields, account's VK_api
+        super().__init__()
+        # uid: Presence
+        self.is_online = PresenceTracker(
+            fetch_presence
+            or (lambda ids: GLOBAL_VK.users__get(ids, fields=PRESENCE_FIELDS)),
+            GLOBAL_WORKERS.submit,
+            on_update=lambda: request_redraw(),
+        )
+        # peer ids by last message, profiles are in GLOBAL_PROFILES
+        self.dialogs = DialogIndex()
+        self.history_loading = set()  # ids with get_last_n_messages running
+        # getConversations pages are loaded one after another from this offset,
+        # dialogs index has more peers: long pool and store add them too
+        self.dialogs_loaded_offset = 0
+        self.dialogs_loading = False
 
-        id
-    ]
-    """
+
+# scrollback - Scrollback of opened chat, None - live view
+# dialogs_offset - first dialog on ALL_CHATS_PAGE
+View = namedtuple("View", "state args multiline_input scrollback dialogs_offset")
 
 
 class State:
-    state = StateType.ALL_CHATS_PAGE
-    args = []
-    multiline_input = False
+    """
+    UI state: `view` is replaced as a whole by input thread, renderer takes
+    it once per frame, so it never sees half of a transition and input
+    never waits for rendering
+    """
 
     def __init__(self):
-        self.rw_mutex = Lock()
+        self.view = View(StateType.ALL_CHATS_PAGE, (), False, None, 0)
+
+    def set(self, **changes):
+        self.view = self.view._replace(**changes)
 
 
 GLOBAL_STATUS = Status()
@@ -130,6 +180,26 @@ def run_in_other_thread(func):
     return f
 
 
+def run_in_pool(priority):
+    """
+    make function run in GLOBAL_WORKERS with given priority, call returns Future
+    func.with_priority(other)(*args) - submit once with other priority
+    """
+
+    def decorator(func):
+        def f(*args, **kwargs):
+            return GLOBAL_WORKERS.submit(priority, func, *args, **kwargs)
+
+        f.with_priority = lambda priority: (
+            lambda *args, **kwargs: GLOBAL_WORKERS.submit(
+                priority, func, *args, **kwargs
+            )
+        )
+        return f
+
+    return decorator
+
+
 class synchronize_with_lock:
     """
     Synchronize decorator
@@ -172,138 +242,211 @@ class synchronize_with_lock:
 
 
 def clear():
+    import click  # edit, slow to import, first frame is painted with it
+
     click.clear()
     # print('\n'*10)
     pass
 
 
-def update_users_info():
-    to_update = {}
-    with GLOBAL_STATUS.users_write_mutex:
-        for ind, user_info in enumerate(list(GLOBAL_STATUS.users)):
-            uid = None
-            if isinstance(user_info, dict):
-                if not "recheck" in user_info:
-                    continue
-                uid = user_info["id"]
-            else:
-                uid = user_info
-            to_update[uid] = ind
-        success, res = GLOBAL_VK.users__get(to_update)
-        if not success:
-            log_error(res)
-            return
-        for info in res:
-            ind = to_update[info["id"]]
-            GLOBAL_STATUS.users[ind] = info
+GLOBAL_SCREEN = Screen(clear)
+# frames are built with redirect_stdout (whole process), one at a time;
+# only painting takes it, not state changes
+GLOBAL_DRAW_MUTEX = TimedLock(Lock(), GLOBAL_METRICS, "draw_mutex_wait_seconds")
+
+
+def _save_profiles(profiles, account):
+    if account.store is not None:
+        account.store.save_users(profiles)
 
 
 def get_online_str(uid):
-    return "[+]" if GLOBAL_STATUS.is_online[uid]["status"] else "[-]"
+    if not 0 < uid < 2000000000:
+        return ""  # groups and chats have no online status
+    presence = GLOBAL_STATUS.is_online.get(uid)
+    if presence is None:
+        return "[?]"  # not loaded yet
+    return "[+]" if presence.status else "[-]"
     pass
 
 
 def get_name_by_id(id):
-    for user_info in GLOBAL_STATUS.users:
-        if isinstance(user_info, int):
-            update_users_info()
-            break
-        if user_info["id"] == id:
-            return user_info["first_name"] + " " + user_info["last_name"]
-    for user_info in GLOBAL_STATUS.users:
-        if user_info["id"] == id:
-            return user_info["first_name"] + " " + user_info["last_name"]
-    return str(id)
+    """never blocks: unknown name is fetched in background, id is shown meanwhile"""
+    titles = GLOBAL_STATUS.snapshot.titles
+    if id in titles:
+        return titles[id]
+    if id < 0 or id > 2000000000:  # groups and chats have no profile
+        return str(id)
+    return GLOBAL_PROFILES.name(id)
+
+
+def draw_page(force=False, wait=True):
+    """
+    paint current view
+    wait=False - if other frame is being painted, request one more instead
+    of waiting (it may show older view)
+    """
+    if not wait and GLOBAL_DRAW_MUTEX.lock.locked():
+        request_redraw()
+        return
+    with GLOBAL_DRAW_MUTEX:
+        view = GLOBAL_STATE.view
+        if view.state in [StateType.CHAT_WRITE_MESSAGE_PAGE] and not force:
+            return
+        start = perf_counter()
+        frame = io.StringIO()
+        with redirect_stdout(frame):
+            print(*(v for v in GLOBAL_ERRORS), sep="\n")
+
+            print("-" * 20)
+            print(view.state.name)
+            print("-" * 20)
+            {
+                StateType.ALL_CHATS_PAGE: draw__ALL_CHATS_PAGE,
+                StateType.CHAT_PAGE: draw__CHAT_PAGE,
+                StateType.CHAT_WRITE_MESSAGE_PAGE: draw__CHAT_WRITE_MESSAGE_PAGE,
+                StateType.CHAT_SEND_MESSAGE_PAGE: draw__CHAT_SEND_MESSAGE_PAGE,
+                StateType.SEARCH_PAGE: draw__SEARCH_PAGE,
+            }.get(
+                view.state,
+                lambda *args, view: print(
+                    "Not implemented, state:", view.state, "args:", args
+                ),
+            )(
+                *view.args, view=view
+            )
+        GLOBAL_SCREEN.paint(frame.getvalue())
+        GLOBAL_METRICS.observe(
+            "draw_page_seconds", perf_counter() - start, state=view.state.name
+        )
+        if GLOBAL_FIRST_PAINT is None:
+            first_painted()
+
+
+def first_painted():
+    global GLOBAL_FIRST_PAINT
+    GLOBAL_FIRST_PAINT = perf_counter() - STARTED
+    GLOBAL_METRICS.observe("startup_first_paint_seconds", GLOBAL_FIRST_PAINT)
+    if GLOBAL_FIRST_PAINT > FIRST_PAINT_TARGET:
+        log_error("slow start: first frame in %.3f s" % GLOBAL_FIRST_PAINT)
 
 
-@synchronize_with_lock(GLOBAL_STATE.rw_mutex)
-def draw_page(force=False):
-    if GLOBAL_STATE.state in [StateType.CHAT_WRITE_MESSAGE_PAGE] and not force:
+GLOBAL_REDRAW = RedrawScheduler(draw_page, on_error=log_error)
+
+
+def request_redraw():
+    """redraw page soon, bursts of requests give one repaint"""
+    if not GLOBAL_HEADLESS:
+        GLOBAL_REDRAW.request()
+
+
+def draw_part_accounts():
+    if len(GLOBAL_ACCOUNTS) < 2:
         return
-    clear()
-    print(*(v for v in GLOBAL_ERRORS), sep="\n")
-
-    print("-" * 20)
-    print(GLOBAL_STATE.state.name)
-    print("-" * 20)
-    {
-        StateType.ALL_CHATS_PAGE: draw__ALL_CHATS_PAGE,
-        StateType.CHAT_PAGE: draw__CHAT_PAGE,
-        StateType.CHAT_WRITE_MESSAGE_PAGE: draw__CHAT_WRITE_MESSAGE_PAGE,
-        StateType.CHAT_SEND_MESSAGE_PAGE: draw__CHAT_SEND_MESSAGE_PAGE,
-    }.get(
-        GLOBAL_STATE.state,
-        lambda *args: print(
-            "Not implemented, state:", GLOBAL_STATE.state, "args:", args
+    print(
+        "accounts:",
+        *(
+            "%s[a%d] %s%s"
+            % (
+                "*" if account is GLOBAL_ACCOUNT else "",
+                index,
+                account.name,
+                " (%d)" % account.unread if account.unread else "",
+            )
+            for index, account in enumerate(GLOBAL_ACCOUNTS, 1)
         ),
-    )(
-        *GLOBAL_STATE.args
     )
 
 
-def draw__ALL_CHATS_PAGE(*args):
-    update_users_info()
-    for index, user_info in enumerate(GLOBAL_STATUS.users, 1):
-        uid = user_info["id"]
-        if not uid in GLOBAL_STATUS.is_online:
-            update_user_online_status(uid)
-            if not uid in GLOBAL_STATUS.messages:
-                get_last_n_messages(uid)
-
+def draw__ALL_CHATS_PAGE(*args, view):
+    draw_part_accounts()
+    account = GLOBAL_ACCOUNT
+    status = account.status
+    snapshot = status.snapshot
+    offset = view.dialogs_offset
+    peers = status.dialogs.page(offset, DIALOGS_ON_SCREEN)
+    if (
+        len(peers) < DIALOGS_ON_SCREEN
+        and status.dialogs_loaded_offset < snapshot.dialogs_count
+    ):
+        load_more_dialogs(account)
+    users = [uid for uid in peers if 0 < uid < 2000000000]
+    GLOBAL_PROFILES.prefetch(users)
+    # no requests here: missing and stale presences are fetched in background
+    status.is_online.prefetch(users)
+    no_messages = [
+        uid
+        for uid in peers
+        if not uid in snapshot.messages and not uid in status.history_loading
+    ]
+    if no_messages:
+        status.history_loading.update(no_messages)
+        get_last_n_messages(*no_messages, account=account)
+    for index, uid in enumerate(peers, offset + 1):
         # TODO: add check if new messages exists
+        presence = status.is_online.get(uid) if uid in users else None
         print(
             index,
             "]",
             get_name_by_id(uid),
-            datetime.fromtimestamp(GLOBAL_STATUS.is_online[uid]["timestamp"]).strftime(
-                "%H:%M:%S"
-            ),
+            presence.strftime if presence else "--:--:--",
             get_online_str(uid),
             end="\n" + "-" * 10 + "\n",
         )
+    print(
+        "%d-%d of %d" % (offset + 1, offset + len(peers), snapshot.dialogs_count),
+        "(n - next, p - previous, /text - search)",
+    )
 
 
-@autorun
-@mark_as_deamon
-@run_in_other_thread
-def mark_messages_as_read(messages):
-    to_mark = []
-    for msg in messages:
-        if not msg["out"]:
-            to_mark.append(msg["m_id"])
-    log_error(("mark as read", to_mark))
-    return
-    success, res = GLOBAL_VK.messages__mark_as_read(to_mark)
-    if not success:
-        log_error(res)
+def mark_messages_as_read(peer_id, messages):
+    """queue incoming messages, they are marked in one request per window"""
+    GLOBAL_READ_RECEIPTS.add(peer_id, messages)
 
 
-def draw_part_chat(chat_id):
-    for msg in GLOBAL_STATUS.messages[chat_id]:
-        if "fwd" in msg:
+def draw_part_chat(chat_id, messages=None):
+    live = messages is None
+    if live:
+        messages = GLOBAL_STATUS.snapshot.messages.get(chat_id, ())
+    # details of attachments on screen are loaded in background, once
+    GLOBAL_ATTACHMENTS.prefetch(messages)
+    for msg in messages:
+        if msg.fwd:
             print("[fwd]", end="")
-        print("<< " if msg["out"] else ">> ", msg["strftime"], end=" ")
-        if "sticker" in msg:
-            print("[sticker]", msg["sticker"])
+        print("<< " if msg.out else ">> ", msg.strftime, end=" ")
+        if msg.sticker is not None:
+            print("[sticker]", msg.sticker)
         else:
-            print(msg["body"])
+            print(msg.body)
 
-        if "attachments" in msg:
-            print(msg["attachments"])
+        for key in msg.attachments:
+            print("   ", GLOBAL_ATTACHMENTS.describe(key))
+    if live:
+        for pending in GLOBAL_SENDER.pending(chat_id):
+            print("<< ", "[%s]" % pending.state, pending.body)
 
 
-def draw__CHAT_PAGE(chat_id=None, *args):
+def draw__CHAT_PAGE(chat_id=None, *args, view):
     if chat_id is None:
         return
+    GLOBAL_STATUS.is_online.prefetch([chat_id])
     print(get_name_by_id(chat_id), get_online_str(chat_id))
+    typing = GLOBAL_STATUS.snapshot.typing.get(chat_id)
+    if typing and monotonic() - typing[1] < TYPING_SHOWN:
+        print(get_name_by_id(typing[0]), "is typing...")
     print("\n" * 2)
-    draw_part_chat(chat_id)
+    scrollback = view.scrollback
+    if scrollback is None or scrollback.at_live:
+        draw_part_chat(chat_id)
+    else:
+        draw_part_chat(chat_id, scrollback.page())
+        print("[history]", "loading..." if scrollback.loading else "")
     draw_part_menu(
-        ["back", "write message"], 0
+        ["back", "write message", "older", "newer"], 0
     )  # TODO: add option mark as read, if no read by default
 
 
-def draw__CHAT_SEND_MESSAGE_PAGE(uid, msg, *args):
+def draw__CHAT_SEND_MESSAGE_PAGE(uid, msg, *args, view):
     print("-" * 6)
     print(
         "send",
@@ -316,7 +459,7 @@ def draw__CHAT_SEND_MESSAGE_PAGE(uid, msg, *args):
     print("-" * 6)
 
 
-def draw__CHAT_WRITE_MESSAGE_PAGE(uid, *args):
+def draw__CHAT_WRITE_MESSAGE_PAGE(uid, *args, view):
     print("message to user", get_name_by_id(uid))
     print("-" * 4)
     draw_part_chat(uid)
@@ -325,6 +468,20 @@ def draw__CHAT_WRITE_MESSAGE_PAGE(uid, *args):
     print("-" * 4)
 
 
+def draw__SEARCH_PAGE(query, results, *args, view):
+    print("search:", query, "- %d found" % len(results))
+    for index, (peer_id, msg, snippet) in enumerate(results, 1):
+        print(
+            index,
+            "]",
+            get_name_by_id(peer_id),
+            msg.strftime,
+            "<<" if msg.out else ">>",
+            snippet,
+        )
+    draw_part_menu(["back"], 0, "number - open chat, /text - search again")
+
+
 def draw_part_menu(options: list, iterable_or_start=1, extra=None):
     keys = None
     if isinstance(iterable_or_start, int):
@@ -338,250 +495,847 @@ def draw_part_menu(options: list, iterable_or_start=1, extra=None):
         print(extra)
 
 
-@synchronize_with_lock(GLOBAL_STATE.rw_mutex)
 def user_input_handler(query):
-    print("ask for:", query)
+    """
+    change view for one line of input, no locks: view is replaced at once,
+    account data is read from snapshot
+    """
+    view = GLOBAL_STATE.view
 
-    if GLOBAL_STATE.state == StateType.ALL_CHATS_PAGE:
+    if view.state == StateType.ALL_CHATS_PAGE:
+        dialogs = GLOBAL_STATUS.dialogs
+        if query == "n":
+            if view.dialogs_offset + DIALOGS_ON_SCREEN < max(
+                len(dialogs), GLOBAL_STATUS.snapshot.dialogs_count
+            ):
+                GLOBAL_STATE.set(dialogs_offset=view.dialogs_offset + DIALOGS_ON_SCREEN)
+            return False
+        if query == "p":
+            GLOBAL_STATE.set(
+                dialogs_offset=max(0, view.dialogs_offset - DIALOGS_ON_SCREEN)
+            )
+            return False
+        if query.startswith("/"):
+            return search(query[1:])
+        if query[:1] == "a" and query[1:].isdigit():
+            index = int(query[1:]) - 1
+            if 0 <= index < len(GLOBAL_ACCOUNTS):
+                use_account(GLOBAL_ACCOUNTS[index])
+            return False
         if not query.isdigit():
             return False
         ind = int(query) - 1
-        if ind >= len(GLOBAL_STATUS.users) or ind < 0:
+        peers = dialogs.page(ind, 1) if ind >= 0 else []
+        if not peers:
             return False
 
-        chat_id = GLOBAL_STATUS.users[ind]["id"]
-        GLOBAL_STATE.args = [chat_id]
-        GLOBAL_STATE.state = StateType.CHAT_PAGE
-        mark_messages_as_read(GLOBAL_STATUS.messages[chat_id])
+        open_chat(peers[0])
+        return False
+    if view.state == StateType.SEARCH_PAGE:
+        if query.startswith("/"):
+            return search(query[1:])
+        if not query.isdigit():
+            return False
+        ind = int(query)
+        if ind == 0:
+            GLOBAL_STATE.set(args=(), state=StateType.ALL_CHATS_PAGE)
+            return False
+        results = view.args[1]
+        if ind <= len(results):
+            open_chat(results[ind - 1][0])
         return False
-    if GLOBAL_STATE.state == StateType.CHAT_PAGE:
+    if view.state == StateType.CHAT_PAGE:
         if not query.isdigit():
             return False
         query = int(query)
         if query == 0:
-            GLOBAL_STATE.args = []
-            GLOBAL_STATE.state = StateType.ALL_CHATS_PAGE
+            GLOBAL_STATE.set(args=(), scrollback=None, state=StateType.ALL_CHATS_PAGE)
+            return False
+        if query == 2:
+            scrollback = view.scrollback
+            if scrollback is None:
+                scrollback = make_scrollback(view.args[0], GLOBAL_ACCOUNT)
+                GLOBAL_STATE.set(scrollback=scrollback)
+            scrollback.older()
+            return False
+        if query == 3:
+            if view.scrollback is not None:
+                view.scrollback.newer()
+                if view.scrollback.at_live:
+                    GLOBAL_STATE.set(scrollback=None)
             return False
         if query == 1:
-            mark_messages_as_read(GLOBAL_STATUS.messages[GLOBAL_STATE.args[0]])
-            GLOBAL_STATE.multiline_input = True
-            GLOBAL_STATE.state = StateType.CHAT_WRITE_MESSAGE_PAGE
+            mark_messages_as_read(
+                view.args[0], GLOBAL_STATUS.snapshot.messages.get(view.args[0], ())
+            )
+            GLOBAL_STATE.set(
+                scrollback=None,
+                multiline_input=True,
+                state=StateType.CHAT_WRITE_MESSAGE_PAGE,
+            )
             return True
         return False
-    if GLOBAL_STATE.state == StateType.CHAT_WRITE_MESSAGE_PAGE:
-        GLOBAL_STATE.multiline_input = False
+    if view.state == StateType.CHAT_WRITE_MESSAGE_PAGE:
         if query == "":
-            GLOBAL_STATE.state = StateType.CHAT_PAGE
+            GLOBAL_STATE.set(multiline_input=False, state=StateType.CHAT_PAGE)
             return False
-        GLOBAL_STATE.args.append(query)
-        GLOBAL_STATE.state = StateType.CHAT_SEND_MESSAGE_PAGE
+        GLOBAL_STATE.set(
+            args=view.args + (query,),
+            multiline_input=False,
+            state=StateType.CHAT_SEND_MESSAGE_PAGE,
+        )
         return False
-    if GLOBAL_STATE.state == StateType.CHAT_SEND_MESSAGE_PAGE:
+    if view.state == StateType.CHAT_SEND_MESSAGE_PAGE:
         if query in ["yes", "y", ""]:
-            GLOBAL_VK.message__send(*GLOBAL_STATE.args)
-        GLOBAL_STATE.args = GLOBAL_STATE.args[:1]
-        GLOBAL_STATE.state = StateType.CHAT_PAGE
+            send_message(*view.args)
+        GLOBAL_STATE.set(args=view.args[:1], state=StateType.CHAT_PAGE)
         return False
     return False
 
 
-def update_user_online_status(user_id):
-    success, res = GLOBAL_VK.messages__getLastActivity(user_id)
-    if not success:
-        log_error(res)
+def open_chat(chat_id):
+    GLOBAL_STATE.set(args=(chat_id,), scrollback=None, state=StateType.CHAT_PAGE)
+    messages = GLOBAL_STATUS.snapshot.messages.get(chat_id)
+    if messages is not None:
+        mark_messages_as_read(chat_id, messages)
+    else:  # not prefetched yet, load before anything else
+        get_last_n_messages.with_priority(FOREGROUND)(
+            chat_id, account=GLOBAL_ACCOUNT
+        ).add_done_callback(lambda future: request_redraw())
+
+
+def search_messages(query, limit=SEARCH_LIMIT):
+    """ranked hits in local history of all chats, no api calls"""
+    if GLOBAL_STORE is None:
+        log_error("search needs message store")
+        return []
+    start = perf_counter()
+    results = GLOBAL_STORE.search(query, limit)
+    GLOBAL_METRICS.observe("search_seconds", perf_counter() - start)
+    return results
+
+
+def search(query):
+    """show SEARCH_PAGE with results of query"""
+    query = query.strip()
+    GLOBAL_STATE.set(args=(query, search_messages(query)), state=StateType.SEARCH_PAGE)
+    return False
+
 
-        GLOBAL_STATUS.is_online[user_id] = {"status": 0, "timestamp": 0}
+@run_in_pool(PREFETCH)
+def get_last_n_messages(*user_ids, account):
+    """load history for all user_ids with one batched request"""
+    status = account.status
+    loaded = {}
+    try:
+        for user_id, (success, res) in account.vk.messages__getHistory_many(
+            user_ids, MESSAGES_LIMIT
+        ).items():
+            if not success:
+                log_error(res)
+                loaded[user_id] = ()
+                continue
+
+            loaded[user_id] = tuple(map(Message.from_api, res["items"][::-1]))
+            if account.store is not None:
+                account.store.save_messages(user_id, loaded[user_id])
+    finally:
+        with status.writing() as draft:  # all chats appear in one snapshot
+            draft.messages.update(loaded)
+        status.history_loading.difference_update(user_ids)
+
+
+def load_more_dialogs(account):
+    """next page of conversations, if it is not being loaded already"""
+    status = account.status
+    if status.dialogs_loading:
         return
+    status.dialogs_loading = True
+    load_dialogs(account, status.dialogs_loaded_offset)
 
-    GLOBAL_STATUS.is_online[user_id] = {
-        "status": res["online"],
-        "timestamp": res["time"],
-    }
+
+@run_in_pool(PREFETCH)
+def load_dialogs(account, offset=0):
+    """load page of conversations into account.status.dialogs"""
+    try:
+        _load_dialogs(account, offset)
+    finally:
+        account.status.dialogs_loading = False
 
 
-@autorun
-@mark_as_deamon
-@run_in_other_thread
-def get_last_n_messages(user_id):
-    success, res = GLOBAL_VK.messages__getHistory(user_id, MESSAGES_LIMIT)
+def _load_dialogs(account, offset):
+    status = account.status
+    success, res = account.vk.messages__getConversations(offset, DIALOGS_PAGE)
     if not success:
         log_error(res)
-        GLOBAL_STATUS.messages[user_id] = deque(maxlen=MESSAGES_LIMIT)
         return
+    with status.writing() as draft:
+        draft.dialogs_count = res["count"]
+        for item in res["items"]:
+            conversation = item["conversation"]
+            peer_id = conversation["peer"]["id"]
+            if "chat_settings" in conversation:
+                draft.titles[peer_id] = conversation["chat_settings"]["title"]
+            status.dialogs.update(peer_id, item["last_message"]["date"])
+        for group in res.get("groups", ()):
+            draft.titles[-group["id"]] = group["name"]
+    status.dialogs_loaded_offset = max(
+        status.dialogs_loaded_offset, offset + len(res["items"])
+    )
+    account.profiles.put(map(User.from_api, res.get("profiles", ())))
+    request_redraw()
 
-    def _perfomr_message(e):
-        res = {
-            "m_id": e["id"],
-            "out": e["out"],
-            "timestamp": e["date"],
-            "body": e["body"],
-            "read_state": e["read_state"],
-            "strftime": datetime.fromtimestamp(e["date"]).strftime(
-                "%H:%M:%S"
-            ),  # TODO: remove
-        }
-        if "fwd_messages" in e:
-            res["fwd"] = True  # TODO: replace
-
-        if "attachments" in e:
-            res["attachments"] = []
-            for attach in e["attachments"]:
-                if attach["type"] == "sticker":
-                    res["sticker"] = (attach["sticker"]["id"],)
-                    return res  # only sticker and no one else can be in attach
-                res["attachments"].append(attach["type"])
-        return res
-
-    GLOBAL_STATUS.messages[user_id] = deque(
-        map(_perfomr_message, res["items"][::-1]),
-        # map(lambda e: {
-        #     'm_id':e['id'],
-        #     'out':e['out'],
-        #     'timestamp':e['date'],
-        #     'body':e['body'],
-        #     'read_state':e['read_state'],
-        #     'strftime': datetime.fromtimestamp(e['date']).strftime('%H:%M:%S') # TODO: remove
-        #     }, res['items'][::-1]
-        # ),
-        maxlen=MESSAGES_LIMIT,
+
+def fetch_history_page(account, peer_id, start_message_id, offset, count):
+    """chronological list of messages, None on error"""
+    success, items = account.vk.messages__getHistory_iter(
+        peer_id, count, offset=offset, start_message_id=start_message_id
+    )
+    if not success:
+        log_error(items)
+        return None
+    messages = [Message.from_api(e) for e in items]  # api dicts are not kept
+    messages.reverse()
+    if account.store is not None:
+        account.store.save_messages(peer_id, messages)
+    return messages
+
+
+def make_scrollback(peer_id, account):
+    def fetch_older(m_id, count):
+        if m_id is None:
+            return fetch_history_page(account, peer_id, None, 0, count)
+        return fetch_history_page(account, peer_id, m_id, 1, count)  # 0 - m_id itself
+
+    def fetch_newer(m_id, count):
+        return fetch_history_page(account, peer_id, m_id, -count, count)
+
+    return Scrollback(
+        account.status.snapshot.messages.get(peer_id, ()),
+        fetch_older,
+        fetch_newer,
+        GLOBAL_WORKERS.submit,
+        request_redraw,
     )
 
 
+def _peer_id(e):
+    """peer of message object from api (v5.52)"""
+    if "chat_id" in e:
+        return 2000000000 + e["chat_id"]
+    return e["user_id"]
+
+
+def merge_messages(peer_id, messages, status=None):
+    """add messages to peer's chat in m_id order, skip already known"""
+    if status is None:
+        status = GLOBAL_STATUS
+    with status.writing() as draft:
+        current = draft.messages.get(peer_id, ())
+        known = {msg.m_id for msg in current}
+        merged = list(current) + [msg for msg in messages if not msg.m_id in known]
+        merged.sort(key=lambda msg: msg.m_id)
+        draft.messages[peer_id] = tuple(merged[-MESSAGES_LIMIT:])
+
+
+def load_from_store(account):
+    """fill account status from on-disk cache, no network, chat list included"""
+    with account.status.writing() as draft:
+        for peer_id, messages in account.store.load_recent(MESSAGES_LIMIT).items():
+            draft.messages[peer_id] = tuple(messages)
+            if messages:
+                account.status.dialogs.update(peer_id, messages[-1].timestamp)
+    account.profiles.put(account.store.load_users().values(), stale=True)
+
+
+@run_in_pool(FOREGROUND)
+def sync_delta(account, ts, pts):
+    """fetch messages that came while app was not running"""
+    if not ts or not pts:
+        return  # first run, chats are loaded by getHistory
+    status = account.status
+    more = True
+    while more:
+        success, items = account.vk.messages__getLongPollHistory_iter(ts, pts)
+        if not success:
+            log_error(items)
+            return
+        by_peer = {}
+        for item in items:  # parsed one by one while response is read
+            by_peer.setdefault(_peer_id(item), []).append(Message.from_api(item))
+        with status.writing() as draft:
+            for peer_id, messages in by_peer.items():
+                account.store.save_messages(peer_id, messages)
+                if peer_id in draft.messages:
+                    merge_messages(peer_id, messages, status)
+        pts = items.rest["new_pts"]
+        more = items.rest.get("more")
+    account.store.set_cursor(pts=pts)
+    request_redraw()
+
+
+def handle_long_pool_response(account: Account, res):
+    if GLOBAL_RECORD is not None and res["updates"]:
+        GLOBAL_RECORD.write(json.dumps(res["updates"], ensure_ascii=False) + "\n")
+        GLOBAL_RECORD.flush()
+    start = perf_counter()
+    events = decode_updates(res["updates"])
+    # handlers write one draft, renderer gets the whole response at once
+    with account.status.writing():
+        handled = account.dispatcher.dispatch(events)
+    if handled:
+        request_redraw()
+    GLOBAL_METRICS.observe("long_pool_handle_seconds", perf_counter() - start)
+    for event_type, count in Counter(event.type for event in events).items():
+        GLOBAL_METRICS.inc("long_pool_events_total", count, type=event_type.name)
+    if account.store is not None:
+        account.store.set_cursor(res["ts"], res.get("pts"))
+
+
 @autorun
 @mark_as_deamon
 class LongPoolThread(Thread):
-    def __init__(self, vk: VK_api, notify_on: dict):
+    """
+    long pool loop of one account, responses go to stream
+    connects to long pool server itself, so start does not wait for network
+    """
+
+    def __init__(self, account: Account, stream: EventStream):
         super(self.__class__, self).__init__()
-        self.vk = vk
-        for k in list(notify_on.keys()):
-            notify_on[k.value] = notify_on[k]
-            del notify_on[k]
-        self.notify_on = notify_on
+        self.account = account
+        self.stream = stream
 
     def run(self):
+        if self.account.vk.connect():  # else get_long_pool retries
+            GLOBAL_METRICS.observe(
+                "startup_long_pool_seconds", perf_counter() - STARTED
+            )
         while 1:
-            # 2 - receive attachments
-            # 64 - receive $extra fields in SET_ONLINE
-            upd = self.vk.get_long_pool({"mode": 2 + 64})["updates"]
-            redraw_page = False
-            for event in upd:
-                if event[0] in self.notify_on.keys():
-                    # print('we got smthg', event[0],flush=True)
-                    for observer in self.notify_on[event[0]]:
-                        observer(event)
-                    redraw_page = True
-            if redraw_page:
-                draw_page()
-
-
-def message_handler(event):
+            res = self.account.vk.get_long_pool({"mode": LONG_POOL_MODE})
+            self.stream.put(self.account, res)
+
+
+def message_handler(event: NewMessage, account: Account):
     """
     message handler
 
-    r =  [4, 243626, 17, 19549540, 1500025181, ' ... ', 'Й']
-
-    r[0] $key == 4 -> message
-    r[1] $message_id
-    r[2] $flags == 1(unread) + !2 (outpbox) 
-    r[3] $from_id
-    r[4] $timestamp
-    r[5] $title(?)
-    r[6] $text
+    [4, 243626, 17, 19549540, 1500025181, ' ... ', 'Й']
+    flags == 1(unread) + !2 (outpbox)
     """
 
-    if not event[3] in WATCH_ON:
-        return  # TODO: delete on release
+    status = account.status
+    if event.flags & OUTBOX:  # may be sent by us
+        account.sender.acknowledge(event.message_id)
 
-    if not (event[2] & 1):  # only new
+    if not (event.flags & UNREAD):  # only new
         return
 
-    msg = {
-        "m_id": event[1],
-        "out": 1 if event[2] & 2 else 0,
-        "timestamp": event[4],
-        "body": html.unescape(event[6]).replace("<br>", "\n"),
-        "strftime": datetime.fromtimestamp(event[4]).strftime(
-            "%H:%M:%S"
-        ),  # TODO: remove
-    }
-    try:
-        GLOBAL_STATUS.messages[event[3]].append(msg)
-    except:
-        GLOBAL_STATUS.messages[event[3]] = deque([msg], maxlen=MESSAGES_LIMIT)
+    status.dialogs.update(event.peer_id, event.timestamp)
+    if account is not GLOBAL_ACCOUNT and not event.flags & OUTBOX:
+        account.unread += 1
+
+    sticker, attachments = from_long_pool(event.attachments, event.message_id)
+    msg = Message(
+        event.message_id,
+        1 if event.flags & OUTBOX else 0,
+        event.timestamp,
+        event.text,
+        fwd="fwd" in event.attachments,
+        sticker=sticker,
+        attachments=attachments,
+    )
+    with status.writing() as draft:
+        messages = draft.messages.get(event.peer_id, ()) + (msg,)
+        draft.messages[event.peer_id] = messages[-MESSAGES_LIMIT:]
+    if account.store is not None:
+        account.store.save_messages(event.peer_id, [msg])
+
+
+def message_flags_handler(event: MessageFlags, account: Account):
+    """drop deleted messages (flag 128 set) from chat and disk cache"""
+    if not event.flags & DELETED or event.peer_id is None:
+        return
+    with account.status.writing() as draft:
+        messages = draft.messages.get(event.peer_id, ())
+        kept = tuple(msg for msg in messages if msg.m_id != event.message_id)
+        if len(kept) != len(messages):
+            draft.messages[event.peer_id] = kept
+    if account.store is not None:  # may be older than messages in memory
+        account.store.delete_message(event.peer_id, event.message_id)
+
+
+def message_edit_handler(event: MessageEdit, account: Account):
+    sticker, attachments = from_long_pool(event.attachments, event.message_id)
+    with account.status.writing() as draft:
+        messages = draft.messages.get(event.peer_id, ())
+        for index, msg in enumerate(messages):
+            if msg.m_id == event.message_id:
+                msg = msg.replace(
+                    body=event.text, sticker=sticker, attachments=attachments
+                )
+                draft.messages[event.peer_id] = (
+                    messages[:index] + (msg,) + messages[index + 1 :]
+                )
+                break
+        else:
+            msg = None
+    if account.store is None:
+        return
+    if msg is not None:
+        account.store.save_messages(event.peer_id, [msg])
+    else:  # not in memory, may be stored and found by search
+        account.store.update_body(
+            event.peer_id, event.message_id, event.text, sticker, attachments
+        )
 
 
-def onlien_offline_handler(event):
+def read_handler(event: ReadUpTo, account: Account):
+    """messages of peer up to local_id are read, incoming (6) or outgoing (7)"""
+    out = 1 if event.type is EventType.READ_OUTBOX else 0
+    with account.status.writing() as draft:
+        messages = draft.messages.get(event.peer_id, ())
+        if any(
+            msg.out == out and msg.m_id <= event.local_id and msg.read_state != 1
+            for msg in messages
+        ):
+            draft.messages[event.peer_id] = tuple(
+                (
+                    msg.replace(read_state=1)
+                    if msg.out == out and msg.m_id <= event.local_id
+                    else msg
+                )
+                for msg in messages
+            )
+
+
+def read_receipts_handler(read, account: Account):
+    """messages marked as read by ReadReceipts, {peer_id: set of m_id}"""
+    changed = {}
+    with account.status.writing() as draft:
+        for peer_id, m_ids in read.items():
+            messages = draft.messages.get(peer_id, ())
+            marked = tuple(
+                (
+                    msg.replace(read_state=1)
+                    if msg.m_id in m_ids and msg.read_state != 1
+                    else msg
+                )
+                for msg in messages
+            )
+            changed[peer_id] = [
+                msg for msg, old in zip(marked, messages) if msg is not old
+            ]
+            if changed[peer_id]:
+                draft.messages[peer_id] = marked
+    if account.store is not None:
+        for peer_id, messages in changed.items():
+            if messages:
+                account.store.save_messages(peer_id, messages)
+    request_redraw()
+
+
+def typing_handler(event: Typing, account: Account):
+    with account.status.writing() as draft:
+        draft.typing[event.peer_id] = (event.user_id, monotonic())
+
+
+def onlien_offline_handler(event: PresenceChange, account: Account):
     """
     online-offline handler
 
-    r = [8, -19549540, 0, 192415126]
-
-    r[0] $key == 8/9 set online/offline
-    r[1] -$user_id
-    r[2] $extra
-    r[3] timestamp
+    [8, -19549540, 0, 192415126]
+    8/9 set online/offline, -$user_id, $extra, timestamp
     """
-    if not abs(event[1]) in WATCH_ON:
-        return  # TODO: delete on release
+    account.status.is_online.set(
+        event.user_id,
+        Presence(1 if event.type is EventType.SET_ONLINE else 0, event.timestamp),
+    )
 
-    log_error(event)
 
-    # print('-'*50)
-    # print("here some update",flush=True)
-    # print('-'*50)
+def send_message(peer_id, msg):
+    """queue message and return at once, chat page shows its state"""
+    return GLOBAL_SENDER.put(peer_id, msg)
 
-    is_online = {
-        "status": 1 if event[0] == EventType.SET_ONLINE else 0,
-        "timestamp": event[3],
-    }
-    GLOBAL_STATUS.is_online[abs(event[1])] = is_online
 
-    draw_page()
+def read_query():
+    try:
+        if GLOBAL_STATE.view.multiline_input:
+            query = sys.stdin.read().strip()
+            GLOBAL_SCREEN.invalidate()  # multiline echo may scroll the terminal
+            return query
+        return input()
+    except EOFError:  # prevent ctrl + D to close program
+        return ""
+
+
+def handle_query(orig_query):
+    """process one line of user input, return False to exit"""
+    query = orig_query.strip().lower()
+    if query == "q" or query == "exit":
+        return False
+    start = perf_counter()
+    force_redraw = user_input_handler(orig_query)
+    GLOBAL_METRICS.observe("user_input_seconds", perf_counter() - start)
+    debug = query.startswith("pd")
+    # a frame being painted by redraw thread is not waited for
+    draw_page(force_redraw, wait=force_redraw or debug)
+    if debug:
+        with GLOBAL_DRAW_MUTEX:  # prints must not go into a frame being built
+            print_debug(query)
+    return True
+
+
+def print_debug(query):
+    # DEBUG OPTIONS
+    if query == "pdo":  # print-debug-online
+        print(*GLOBAL_STATUS.is_online.items(), sep="\n")
+    if query == "pdm":  # print-debug-messages
+        print(dict(GLOBAL_STATUS.snapshot.messages))
+    if query == "pdw":  # print-debug-workers
+        print(GLOBAL_WORKERS.stats())
+    if query == "pdl":  # print-debug-long-pool
+        print(GLOBAL_VK.long_pool_stats)
+    if query == "pdt":  # print-debug-timings
+        for name, values in sorted(GLOBAL_METRICS.snapshot()["histograms"].items()):
+            for labels, h in sorted(values.items()):
+                print(
+                    "%s%s n=%d p50=%.3f p95=%.3f max=%.3f"
+                    % (name, labels, h["count"], h["p50"], h["p95"], h["max"])
+                )
 
 
 def main_loop():
     while 1:
         try:
-            orig_query = None
-            try:
-                if GLOBAL_STATE.multiline_input:
-                    orig_query = sys.stdin.read().strip()
-                else:
-                    orig_query = input()
-            except EOFError:  # prevent ctrl + D to close program
-                pass
-            query = orig_query.strip().lower()
-            if query == "q" or query == "exit":
+            if not handle_query(read_query()):
                 break
-            force_redraw = user_input_handler(orig_query)
-            draw_page(force_redraw)
-            # DEBUG OPTIONS
-            if query == "pdo":  # print-debug-online
-                print(*GLOBAL_STATUS.is_online.items(), sep="\n")
-            if query == "pdm":  # print-debug-messages
-                print(GLOBAL_STATUS.messages)
-
         except KeyboardInterrupt:
             break
     return 0
 
 
-def main():
-    token = None
-    # TODO: next 2 lines not secure and contains no check, add
-    with open("key.token") as f:
-        token = f.readline()
+async def long_pool_task(avk: "AsyncVK_api", account: Account):
+    # all accounts' tasks run in one loop, it is their merged stream
+    while 1:
+        res = await avk.get_long_pool({"mode": LONG_POOL_MODE})
+        handle_long_pool_response(account, res)
 
-    global GLOBAL_VK
-    GLOBAL_VK = VK_api(token)
 
+async def input_task(loop):
+    # input() blocks, so only reading runs in a daemon thread (exit never
+    # waits for Enter); handling runs in loop, together with long pool
+    # handlers, and never waits on them
+    import asyncio
+
+    reader = WorkerPool(1, name="input")
+    while 1:
+        query = await asyncio.wrap_future(
+            reader.submit(FOREGROUND, read_query), loop=loop
+        )
+        if not handle_query(query):
+            break
+
+
+def main_async():
+    import asyncio  # slow to import, only this mode needs it
+    from vk_api_async import AsyncVK_api
+
+    loop = asyncio.new_event_loop()  # get_event_loop() without one is deprecated
+    asyncio.set_event_loop(loop)
+    async_vks = [AsyncVK_api(account.vk, loop) for account in GLOBAL_ACCOUNTS]
+    draw_page()
+    tasks = [
+        loop.create_task(long_pool_task(avk, account))
+        for avk, account in zip(async_vks, GLOBAL_ACCOUNTS)
+    ]
+    try:
+        loop.run_until_complete(input_task(loop))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for task in tasks:
+            task.cancel()
+        loop.run_until_complete(asyncio.gather(*tasks, return_exceptions=True))
+        for avk in async_vks:
+            avk.close()
+        loop.close()
+    return 0
+
+
+def make_notify_on(account: Account, publish=None):
+    """handlers bound to account, publish(event) gets every event if given"""
     notify_on = {
         EventType.MESSAGE: [message_handler],
+        EventType.MESSAGE_FLAGS_SET: [message_flags_handler],
+        EventType.MESSAGE_EDIT: [message_edit_handler],
+        EventType.READ_INBOX: [read_handler],
+        EventType.READ_OUTBOX: [read_handler],
+        EventType.TYPING: [typing_handler],
+        EventType.TYPING_IN_CHAT: [typing_handler],
         EventType.SET_ONLINE: [onlien_offline_handler],
         EventType.SET_OFFLINE: [onlien_offline_handler],
     }
-    lp = LongPoolThread(GLOBAL_VK, notify_on)
-    draw_page()
+    notify_on = {
+        event_type: [partial(handler, account=account) for handler in handlers]
+        for event_type, handlers in notify_on.items()
+    }
+    if publish is not None:
+        for event_type in EventType:
+            notify_on.setdefault(event_type, []).append(publish)
+    return notify_on
+
+
+def make_account(name, token, store_path=STORE_PATH, **vk_options):
+    """
+    account with cache loaded from disk and history since last run requested
+    in background; no blocking network calls, long pool is not started
+    """
+    account = Account(name, token)
+    account.status = Status(
+        lambda ids: account.vk.users__get(ids, fields=PRESENCE_FIELDS)
+    )
+    account.profiles = ProfileCache(
+        lambda ids: account.vk.users__get(ids),
+        GLOBAL_WORKERS.submit,
+        on_update=lambda: request_redraw(),
+        on_fetched=partial(_save_profiles, account=account),
+    )
+    account.attachments = AttachmentCache(
+        lambda message_ids: account.vk.messages__getById(message_ids),
+        GLOBAL_WORKERS.submit,
+        on_update=lambda: request_redraw(),
+    )
+    ts = pts = None
+    if store_path is not None:
+        account.store = MessageStore(store_path)
+        load_from_store(account)
+        # read before long pool starts to overwrite it
+        ts, pts = account.store.get_cursor()
+    # long pool server is requested by long pool thread, not here
+    account.vk = VK_api(token, metrics=GLOBAL_METRICS, connect=False, **vk_options)
+    account.sender = SendQueue(
+        lambda peer_id, msg, random_id: account.vk.message__send(
+            peer_id, msg, random_id
+        ),
+        on_update=lambda: request_redraw(),
+    )
+    account.read_receipts = ReadReceipts(
+        lambda ids: account.vk.messages__mark_as_read(ids),
+        GLOBAL_WORKERS.submit,
+        on_read=partial(read_receipts_handler, account=account),
+        on_error=log_error,
+    )
+    account.dispatcher = Dispatcher(make_notify_on(account))
+    if store_path is not None:
+        sync_delta(account, ts, pts)
+    GLOBAL_ACCOUNTS.append(account)
+    return account
+
+
+def use_account(account: Account):
+    """show account, ui and user commands work with it"""
+    global GLOBAL_ACCOUNT, GLOBAL_VK, GLOBAL_STATUS, GLOBAL_STORE
+    global GLOBAL_SENDER, GLOBAL_READ_RECEIPTS, GLOBAL_PROFILES, GLOBAL_ATTACHMENTS
+    if account is GLOBAL_ACCOUNT:
+        return
+    GLOBAL_ACCOUNT = account
+    GLOBAL_VK = account.vk
+    GLOBAL_STATUS = account.status
+    GLOBAL_STORE = account.store
+    GLOBAL_SENDER = account.sender
+    GLOBAL_READ_RECEIPTS = account.read_receipts
+    GLOBAL_PROFILES = account.profiles
+    GLOBAL_ATTACHMENTS = account.attachments
+    account.unread = 0
+    GLOBAL_STATE.set(
+        state=StateType.ALL_CHATS_PAGE, args=(), scrollback=None, dialogs_offset=0
+    )
+    if not GLOBAL_STATUS.snapshot.dialogs_count:
+        load_more_dialogs(account)
+
+
+def start_long_pool():
+    """one long pool thread per account, all handled by GLOBAL_STREAM"""
+    global GLOBAL_STREAM
+    GLOBAL_STREAM = EventStream(handle_long_pool_response, on_error=log_error)
+    for account in GLOBAL_ACCOUNTS:
+        LongPoolThread(account, GLOBAL_STREAM)
+
+
+def api_dialogs(offset=0, count=DIALOGS_ON_SCREEN):
+    return [
+        {"peer_id": peer_id, "title": get_name_by_id(peer_id)}
+        for peer_id in GLOBAL_STATUS.dialogs.page(offset, count)
+    ]
+
+
+def api_messages(peer_id, count=MESSAGES_LIMIT):
+    if peer_id not in GLOBAL_STATUS.snapshot.messages:
+        get_last_n_messages.with_priority(FOREGROUND)(
+            peer_id, account=GLOBAL_ACCOUNT
+        ).result()
+    messages = GLOBAL_STATUS.snapshot.messages.get(peer_id, ())
+    return [msg.as_dict() for msg in messages[-count:]]
+
+
+def _account(name):
+    """account by name for api calls, shown one if name is None"""
+    if name is None:
+        return GLOBAL_ACCOUNT
+    for account in GLOBAL_ACCOUNTS:
+        if account.name == name:
+            return account
+    raise KeyError("no account %s" % name)
+
+
+def api_accounts():
+    return [
+        {
+            "name": account.name,
+            "shown": account is GLOBAL_ACCOUNT,
+            "unread": account.unread,
+        }
+        for account in GLOBAL_ACCOUNTS
+    ]
+
+
+def api_send(peer_id, text, account=None):
+    """queue message, its state can be checked with `pending`"""
+    msg = _account(account).sender.put(peer_id, text)
+    return {"random_id": msg.random_id, "state": msg.state}
+
+
+def api_pending(peer_id, account=None):
+    return [
+        {
+            "random_id": msg.random_id,
+            "state": msg.state,
+            "m_id": msg.m_id,
+            "error": msg.error,
+        }
+        for msg in _account(account).sender.pending(peer_id)
+    ]
+
+
+def api_presence(user_ids):
+    missing = [
+        uid
+        for uid in user_ids
+        if 0 < uid < 2000000000 and uid not in GLOBAL_STATUS.is_online
+    ]
+    if missing:
+        GLOBAL_STATUS.is_online.load(missing)
+    return {
+        uid: GLOBAL_STATUS.is_online[uid].as_dict()
+        for uid in user_ids
+        if uid in GLOBAL_STATUS.is_online
+    }
+
+
+def api_search(query, limit=SEARCH_LIMIT):
+    return [
+        {"peer_id": peer_id, "message": msg.as_dict(), "snippet": snippet}
+        for peer_id, msg, snippet in search_messages(query, limit)
+    ]
+
+
+def api_stats():
+    return {
+        "workers": GLOBAL_WORKERS.stats(),
+        "long_pool": {
+            account.name: account.vk.long_pool_stats for account in GLOBAL_ACCOUNTS
+        },
+        "errors": [str(e) for e in GLOBAL_ERRORS],
+        "metrics": GLOBAL_METRICS.snapshot(),
+    }
+
+
+def main_daemon():
+    """
+    only long pool and send queue, clients use unix socket api (daemon.py),
+    all of them share one long pool connection and one rate limit per account;
+    events are tagged with account name
+    """
+    hub = EventHub()
+    for account in GLOBAL_ACCOUNTS:
+        account.dispatcher = Dispatcher(
+            make_notify_on(account, partial(hub.publish, account=account.name))
+        )
+    start_long_pool()
+    server = ApiServer(
+        _arg_value("--socket") or SOCKET_PATH,
+        {
+            "accounts": api_accounts,
+            "dialogs": api_dialogs,
+            "messages": api_messages,
+            "send": api_send,
+            "pending": api_pending,
+            "presence": api_presence,
+            "search": api_search,
+            "stats": api_stats,
+        },
+        hub,
+    )
+    print("listening on", server.path)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+    return 0
+
+
+def _arg_value(name):
+    """value of `--name VALUE` command line option or None"""
+    if name in sys.argv[1:-1]:
+        return sys.argv[sys.argv.index(name) + 1]
+    return None
+
+
+def setup_metrics():
+    GLOBAL_METRICS.describe("draw_page_seconds", "frame build and paint")
+    GLOBAL_METRICS.describe("draw_mutex_wait_seconds", "wait for frame of other thread")
+    GLOBAL_METRICS.describe("user_input_seconds", "handling of one input line")
+    GLOBAL_METRICS.describe(
+        "long_pool_handle_seconds", "decode and dispatch of long pool response"
+    )
+    for key in GLOBAL_VK.long_pool_stats:  # sum of all accounts
+        GLOBAL_METRICS.gauge(
+            "vk_long_pool_%s" % key,
+            lambda key=key: sum(
+                account.vk.long_pool_stats[key] for account in GLOBAL_ACCOUNTS
+            ),
+        )
+    port = _arg_value("--metrics-port")
+    if port is not None:
+        serve(GLOBAL_METRICS, int(port))
+    path = _arg_value("--metrics-dump")
+    if path is not None:
+        JsonDumper(GLOBAL_METRICS, path).start()
+
+
+def main():
+    # TODO: tokens are read as is, not secure and contains no check, add
+    tokens = read_tokens()
+
+    global GLOBAL_RECORD, GLOBAL_HEADLESS
+    GLOBAL_HEADLESS = "--daemon" in sys.argv[1:]
+    record = _arg_value("--record")
+    if record is not None:  # replay with bench.longpoll_replay
+        GLOBAL_RECORD = open(record, "a")
+    for index, (name, token) in enumerate(tokens):
+        # first account keeps messages.db of single account times
+        make_account(name, token, STORE_PATH if not index else "messages-%s.db" % name)
+    use_account(GLOBAL_ACCOUNTS[0])
+    setup_metrics()
+
+    if GLOBAL_HEADLESS:
+        return main_daemon()
+    if "--async" in sys.argv[1:]:
+        return main_async()
+    draw_page()  # from cache, before any network
+    start_long_pool()
     return main_loop()
 
 
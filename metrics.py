@@ -0,0 +1,272 @@
+# -*- coding: utf-8 -*-
+"""
+In-process metrics: counters, histograms and gauges with labels
+
+exported as prometheus text (serve()) or json (snapshot(), JsonDumper)
+"""
+
+import bisect
+import json
+import os
+import threading
+import time
+
+# seconds, upper bounds of histogram buckets
+LATENCY_BUCKETS = (
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+    30.0,
+)
+DUMP_INTERVAL = 60  # seconds between json dumps
+
+
+class Histogram:
+    __slots__ = ("buckets", "counts", "count", "sum", "max")
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # last one is +Inf
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        # under Metrics lock
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        if value > self.max:
+            self.max = value
+
+    def quantile(self, q):
+        """upper bound of bucket holding q-quantile, max for the last bucket"""
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= rank:
+                return min(bound, self.max)
+        return self.max
+
+
+class _Timer:
+    def __init__(self, metrics, name, labels):
+        self.metrics = metrics
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.metrics.observe(self.name, time.perf_counter() - self.start, **self.labels)
+
+
+class TimedLock:
+    """Lock-like wrapper, time spent waiting for lock goes to histogram `name`"""
+
+    def __init__(self, lock, metrics, name, **labels):
+        self.lock = lock
+        self.metrics = metrics
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self):
+        start = time.perf_counter()
+        self.lock.acquire()
+        self.metrics.observe(self.name, time.perf_counter() - start, **self.labels)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.lock.release()
+
+
+def _key(labels):
+    return tuple(sorted(labels.items()))
+
+
+def _format_labels(key, extra=()):
+    pairs = list(key) + list(extra)
+    if not pairs:
+        return ""
+    return "{%s}" % ",".join(
+        '%s="%s"' % (k, str(v).replace("\\", "\\\\").replace('"', '\\"'))
+        for k, v in pairs
+    )
+
+
+class Metrics:
+    """
+    Registry of metrics, thread-safe
+
+    metrics.inc('vk_api_errors_total', method='users.get')
+    metrics.observe('vk_api_request_seconds', 0.12, method='users.get')
+    with metrics.time('draw_page_seconds'):
+        ...
+    metrics.gauge('workers_queue_depth', lambda: pool.queue_depth)
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.help = {}
+        self.counters = {}  # name: {labels: value}
+        self.histograms = {}  # name: {labels: Histogram}
+        self.gauges = {}  # name: func
+
+    def describe(self, name, help):
+        self.help[name] = help
+
+    def inc(self, name, value=1, **labels):
+        key = _key(labels)
+        with self.lock:
+            values = self.counters.setdefault(name, {})
+            values[key] = values.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        key = _key(labels)
+        with self.lock:
+            values = self.histograms.setdefault(name, {})
+            if key not in values:
+                values[key] = Histogram()
+            values[key].observe(value)
+
+    def time(self, name, **labels):
+        return _Timer(self, name, labels)
+
+    def gauge(self, name, func, help=None):
+        self.gauges[name] = func
+        if help:
+            self.help[name] = help
+
+    def snapshot(self):
+        """plain dict, for json"""
+        with self.lock:
+            res = {
+                "time": time.time(),
+                "counters": {
+                    name: {_format_labels(k): v for k, v in values.items()}
+                    for name, values in self.counters.items()
+                },
+                "histograms": {
+                    name: {
+                        _format_labels(k): {
+                            "count": h.count,
+                            "sum": h.sum,
+                            "max": h.max,
+                            "p50": h.quantile(0.5),
+                            "p95": h.quantile(0.95),
+                            "p99": h.quantile(0.99),
+                        }
+                        for k, h in values.items()
+                    }
+                    for name, values in self.histograms.items()
+                },
+            }
+        res["gauges"] = {name: func() for name, func in self.gauges.items()}
+        return res
+
+    def prometheus(self):
+        """text exposition format"""
+        lines = []
+
+        def header(name, type_):
+            if name in self.help:
+                lines.append("# HELP %s %s" % (name, self.help[name]))
+            lines.append("# TYPE %s %s" % (name, type_))
+
+        with self.lock:
+            for name, values in sorted(self.counters.items()):
+                header(name, "counter")
+                for k, v in sorted(values.items()):
+                    lines.append("%s%s %s" % (name, _format_labels(k), v))
+            for name, values in sorted(self.histograms.items()):
+                header(name, "histogram")
+                for k, h in sorted(values.items()):
+                    cumulative = 0
+                    bounds = [repr(b) for b in h.buckets] + ["+Inf"]
+                    for bound, count in zip(bounds, h.counts):
+                        cumulative += count
+                        lines.append(
+                            "%s_bucket%s %d"
+                            % (name, _format_labels(k, [("le", bound)]), cumulative)
+                        )
+                    lines.append("%s_sum%s %r" % (name, _format_labels(k), h.sum))
+                    lines.append("%s_count%s %d" % (name, _format_labels(k), h.count))
+        for name, func in sorted(self.gauges.items()):
+            header(name, "gauge")
+            lines.append("%s %s" % (name, func()))
+        return "\n".join(lines) + "\n"
+
+
+def serve(metrics, port, host="127.0.0.1"):
+    """
+    prometheus endpoint in daemon thread
+    GET /metrics - text format, GET /metrics.json - snapshot()
+    """
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path == "/metrics":
+                body = metrics.prometheus()
+                content_type = "text/plain; version=0.0.4"
+            elif self.path == "/metrics.json":
+                body = json.dumps(metrics.snapshot())
+                content_type = "application/json"
+            else:
+                self.send_error(404)
+                return
+            data = body.encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = HTTPServer((host, port), Handler)
+    t = threading.Thread(target=server.serve_forever, name="metrics-http")
+    t.daemon = True
+    t.start()
+    return server
+
+
+class JsonDumper(threading.Thread):
+    """write metrics.snapshot() to `path` every `interval` seconds"""
+
+    def __init__(self, metrics, path, interval=DUMP_INTERVAL):
+        super().__init__(name="metrics-dump")
+        self.daemon = True
+        self.metrics = metrics
+        self.path = path
+        self.interval = interval
+
+    def dump(self):
+        tmp = self.path + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump(self.metrics.snapshot(), f, indent=1, sort_keys=True)
+        os.replace(tmp, self.path)  # readers never see half-written file
+
+    def run(self):
+        while 1:
+            time.sleep(self.interval)
+            try:
+                self.dump()
+            except OSError:  # disk full, dir removed - try next time
+                pass
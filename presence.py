@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+import time
+from threading import Lock
+
+from records import Presence
+from workers import PREFETCH
+
+PRESENCE_TTL = 5 * 60  # seconds, older entries are served but refreshed
+USERS_GET_LIMIT = 1000  # max ids in one users.get
+PRESENCE_FIELDS = "online,last_seen"
+CHAT_PEER_MIN = 2000000000  # peer ids of chats start here, groups are negative
+
+
+def presence_from_api(e):
+    """Presence from users.get object with fields=online,last_seen"""
+    last_seen = e.get("last_seen") or {}
+    return Presence(e.get("online", 0), last_seen.get("time", 0))
+
+
+class PresenceTracker:
+    """
+    Online status of users indexed by id, lookups never touch network
+
+    kept up to date by long pool events 8/9 (set()), entries which are
+    missing or not updated for ttl (users without events: not friends)
+    are queued and fetched in background with bulk users.get
+
+    fetch(ids) -> (success, [users.get object with online, last_seen, ...])
+    submit(priority, func) -> Future, runs func in background
+    on_update() - called after presences are fetched
+    """
+
+    def __init__(self, fetch, submit, on_update=None, ttl=PRESENCE_TTL):
+        self.fetch = fetch
+        self.submit = submit
+        self.on_update = on_update
+        self.ttl = ttl
+        self.presences = {}  # id: (Presence, updated_at)
+        self.pending = set()
+        self.flush_scheduled = False
+        self.lock = Lock()
+
+    def set(self, uid, presence, updated_at=None):
+        """from long pool, newer than anything fetched before"""
+        with self.lock:
+            self.presences[uid] = (presence, updated_at or time.monotonic())
+            self.pending.discard(uid)
+
+    def get(self, uid):
+        """Presence or None, only a lookup: fetch is scheduled by prefetch()"""
+        with self.lock:
+            entry = self.presences.get(uid)
+            return entry[0] if entry is not None else None
+
+    def prefetch(self, uids):
+        with self.lock:
+            now = time.monotonic()
+            for uid in uids:
+                entry = self.presences.get(uid)
+                if entry is None or now - entry[1] > self.ttl:
+                    self._schedule(uid)
+
+    def items(self):
+        with self.lock:
+            return [(uid, entry[0]) for uid, entry in self.presences.items()]
+
+    def __contains__(self, uid):
+        return uid in self.presences
+
+    def __getitem__(self, uid):
+        return self.presences[uid][0]
+
+    def _schedule(self, uid):
+        # under lock
+        if not 0 < uid < CHAT_PEER_MIN:
+            return  # chats and groups have no presence, users.get skips them
+        self.pending.add(uid)
+        if not self.flush_scheduled:
+            self.flush_scheduled = True
+            self.submit(PREFETCH, self._flush)
+
+    def load(self, uids):
+        """fetch presences of uids now, in calls of USERS_GET_LIMIT ids"""
+        uids = list(uids)
+        loaded = False
+        for start in range(0, len(uids), USERS_GET_LIMIT):
+            requested_at = time.monotonic()
+            success, res = self.fetch(uids[start : start + USERS_GET_LIMIT])
+            if not success:
+                continue  # will be requested again on next prefetch
+            chunk = uids[start : start + USERS_GET_LIMIT]
+            found = {e["id"]: presence_from_api(e) for e in res}
+            with self.lock:
+                for uid in chunk:
+                    entry = self.presences.get(uid)
+                    if entry is not None and entry[1] > requested_at:
+                        continue  # long pool event came during request
+                    # ids users.get skipped are not requested again until ttl
+                    presence = found.get(uid, Presence(0, 0))
+                    self.presences[uid] = (presence, requested_at)
+            loaded = True
+        return loaded
+
+    def _flush(self):
+        with self.lock:
+            self.flush_scheduled = False
+            pending, self.pending = list(self.pending), set()
+        if self.load(pending) and self.on_update:
+            self.on_update()
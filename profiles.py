@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+import time
+from threading import Lock
+
+from records import User
+from workers import PREFETCH
+
+PROFILE_TTL = 6 * 3600  # seconds, older profiles are served but refreshed
+USERS_GET_LIMIT = 1000  # max ids in one users.get
+
+
+class ProfileCache:
+    """
+    Users profiles indexed by id, lookups never touch network
+
+    missing and stale (older than ttl) profiles are queued and fetched in
+    background with bulk users.get; stale profile is returned meanwhile,
+    profiles not refreshed for 2 * ttl are evicted
+
+    fetch(ids) -> (success, [users.get object, ...])
+    submit(priority, func) -> Future, runs func in background
+    on_update() - called after profiles are fetched
+    on_fetched(users) - called with every fetched batch of User (e.g. to persist it)
+    """
+
+    def __init__(self, fetch, submit, on_update=None, on_fetched=None, ttl=PROFILE_TTL):
+        self.fetch = fetch
+        self.submit = submit
+        self.on_update = on_update
+        self.on_fetched = on_fetched
+        self.ttl = ttl
+        self.profiles = {}  # id: (User, fetched_at)
+        self.pending = set()
+        self.flush_scheduled = False
+        self.lock = Lock()
+
+    def put(self, users, stale=False):
+        """add profiles, stale - serve them but refresh on first lookup (from disk)"""
+        fetched_at = time.monotonic()
+        if stale:
+            fetched_at -= self.ttl + 1
+        with self.lock:
+            for user in users:
+                self.profiles[user.id] = (user, fetched_at)
+                if not stale:
+                    self.pending.discard(user.id)
+
+    def get(self, uid):
+        """User or None, schedule fetch if it is missing or stale"""
+        with self.lock:
+            entry = self.profiles.get(uid)
+            if entry is None or time.monotonic() - entry[1] > self.ttl:
+                self._schedule(uid)
+            return entry[0] if entry is not None else None
+
+    def prefetch(self, uids):
+        with self.lock:
+            now = time.monotonic()
+            for uid in uids:
+                entry = self.profiles.get(uid)
+                if entry is None or now - entry[1] > self.ttl:
+                    self._schedule(uid)
+
+    def name(self, uid):
+        user = self.get(uid)
+        if user is None:
+            return str(uid)
+        return user.name
+
+    def _schedule(self, uid):
+        # under lock
+        self.pending.add(uid)
+        if not self.flush_scheduled:
+            self.flush_scheduled = True
+            self.submit(PREFETCH, self._flush)
+
+    def _flush(self):
+        with self.lock:
+            self.flush_scheduled = False
+            pending, self.pending = list(self.pending), set()
+        fetched = False
+        for start in range(0, len(pending), USERS_GET_LIMIT):
+            success, res = self.fetch(pending[start : start + USERS_GET_LIMIT])
+            if not success:
+                continue  # will be requested again on next lookup
+            users = [User.from_api(e) for e in res]
+            self.put(users)
+            if self.on_fetched:
+                self.on_fetched(users)
+            fetched = True
+        self.evict()
+        if fetched and self.on_update:
+            self.on_update()
+
+    def evict(self):
+        with self.lock:
+            deadline = time.monotonic() - 2 * self.ttl
+            for uid in [
+                uid
+                for uid, (_, fetched_at) in self.profiles.items()
+                if fetched_at < deadline
+            ]:
+                del self.profiles[uid]
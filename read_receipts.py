@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+import threading
+
+from send_queue import TRANSIENT_ERRORS
+from workers import BACKGROUND
+
+READ_DEBOUNCE = 1.0  # seconds, one messages.markAsRead per window
+MARK_LIMIT = 500  # ids per request, keeps url short
+MARK_RETRIES = 5
+MARK_BACKOFF_MAX = 30.0  # seconds, window after failures is doubled up to it
+
+
+class ReadReceipts:
+    """
+    Coalesce marking messages as read
+
+    add() collects incoming unread messages from any chat, ids are
+    deduplicated and sent with one mark(ids) per debounce window;
+    messages already read locally (read_state) or waiting are skipped;
+    ids failed with transient errors are retried up to `retries` times,
+    window is doubled after every failed flush
+
+    mark(ids) -> (success, res)
+    submit(priority, func) -> Future, runs func in background
+    on_read({peer_id: set of m_id}) - called with messages marked on server
+    """
+
+    def __init__(
+        self,
+        mark,
+        submit,
+        on_read=None,
+        on_error=None,
+        debounce=READ_DEBOUNCE,
+        retries=MARK_RETRIES,
+    ):
+        self.mark = mark
+        self.submit = submit
+        self.on_read = on_read
+        self.on_error = on_error
+        self.debounce = debounce
+        self.retries = retries
+        self.pending = {}  # m_id: peer_id
+        self.in_flight = set()
+        self.attempts = {}  # m_id: failed marks, of ids waiting for retry
+        self.failures = 0  # failed flushes in a row
+        self.timer = None
+        self.lock = threading.Lock()
+
+    def add(self, peer_id, messages):
+        with self.lock:
+            for msg in messages:
+                if (
+                    msg.out
+                    or msg.read_state
+                    or msg.m_id in self.pending
+                    or msg.m_id in self.in_flight
+                ):
+                    continue
+                self.pending[msg.m_id] = peer_id
+            self._start_timer()
+
+    def _start_timer(self):
+        # under lock
+        if self.pending and self.timer is None:
+            delay = min(MARK_BACKOFF_MAX, self.debounce * 2**self.failures)
+            self.timer = threading.Timer(delay, self.submit, (BACKGROUND, self.flush))
+            self.timer.daemon = True
+            self.timer.start()
+
+    def flush(self):
+        import requests  # not at startup, it is slow to import
+
+        with self.lock:
+            self.timer = None
+            pending, self.pending = self.pending, {}
+            self.in_flight.update(pending)
+        ids = sorted(pending)
+        failed = set()
+        read = {}
+        try:
+            for start in range(0, len(ids), MARK_LIMIT):
+                chunk = ids[start : start + MARK_LIMIT]
+                try:
+                    success, res = self.mark(chunk)
+                except requests.RequestException as e:
+                    success, res = False, {"error_code": 0, "error_msg": str(e)}
+                if not success:
+                    if self.on_error:
+                        self.on_error(res)
+                    if _transient(res):
+                        failed.update(chunk)
+                    continue
+                for m_id in chunk:
+                    read.setdefault(pending[m_id], set()).add(m_id)
+        finally:
+            with self.lock:
+                self.in_flight.difference_update(pending)
+                for m_id in ids:
+                    attempts = self.attempts.pop(m_id, 0) + 1
+                    if m_id in failed and attempts <= self.retries:
+                        self.attempts[m_id] = attempts  # retry in next window
+                        self.pending.setdefault(m_id, pending[m_id])
+                self.failures = self.failures + 1 if failed else 0
+                self._start_timer()
+        if read and self.on_read:
+            self.on_read(read)
+
+
+def _transient(error):
+    """network errors (code 0) and api errors worth retrying"""
+    code = error.get("error_code", 0) if isinstance(error, dict) else 0
+    return code in TRANSIENT_ERRORS | {0}
@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+"""
+Compact records for messages, presence and users
+
+__slots__ instead of per-object dict, formatting is done on render
+"""
+
+from datetime import datetime
+
+from attachments import attachment_key
+
+TIME_FORMAT = "%H:%M:%S"
+
+
+def format_time(timestamp):
+    return datetime.fromtimestamp(timestamp).strftime(TIME_FORMAT)
+
+
+class Message:
+    __slots__ = (
+        "m_id",
+        "out",
+        "timestamp",
+        "body",
+        "read_state",
+        "fwd",
+        "sticker",
+        "attachments",
+    )
+
+    def __init__(
+        self,
+        m_id,
+        out,
+        timestamp,
+        body,
+        read_state=None,
+        fwd=False,
+        sticker=None,
+        attachments=(),
+    ):
+        self.m_id = m_id
+        self.out = out
+        self.timestamp = timestamp
+        self.body = body
+        self.read_state = read_state
+        self.fwd = fwd
+        self.sticker = sticker  # sticker id, only sticker can be in such message
+        self.attachments = attachments  # tuple of keys, attachments.attachment_key
+
+    @classmethod
+    def from_api(cls, e):
+        """message object of messages.getHistory (v5.52)"""
+        sticker = None
+        attachments = []
+        for attach in e.get("attachments", ()):
+            if attach["type"] == "sticker":
+                sticker = attach["sticker"]["id"]
+                attachments = []
+                break  # only sticker and no one else can be in attach
+            attachments.append(attachment_key(attach, e["id"]))
+        return cls(
+            e["id"],
+            e["out"],
+            e["date"],
+            e["body"],
+            e["read_state"],
+            "fwd_messages" in e,
+            sticker,
+            tuple(attachments),
+        )
+
+    @property
+    def strftime(self):
+        return format_time(self.timestamp)
+
+    def replace(self, **changes):
+        """copy with changed fields, messages in published snapshots are not changed"""
+        fields = self.as_dict()
+        fields.update(changes)
+        return Message(**fields)
+
+    def as_dict(self):
+        return {name: getattr(self, name) for name in self.__slots__}
+
+    def __repr__(self):
+        return "Message(%r, out=%r, %r)" % (self.m_id, self.out, self.body)
+
+
+class Presence:
+    __slots__ = ("status", "timestamp")
+
+    def __init__(self, status, timestamp):
+        self.status = status
+        self.timestamp = timestamp
+
+    @property
+    def strftime(self):
+        return format_time(self.timestamp)
+
+    def as_dict(self):
+        return {"status": self.status, "timestamp": self.timestamp}
+
+    def __repr__(self):
+        return "Presence(%r, %r)" % (self.status, self.timestamp)
+
+
+class User:
+    __slots__ = ("id", "first_name", "last_name")
+
+    def __init__(self, id, first_name, last_name):
+        self.id = id
+        self.first_name = first_name
+        self.last_name = last_name
+
+    @classmethod
+    def from_api(cls, e):
+        return cls(e["id"], e["first_name"], e["last_name"])
+
+    @property
+    def name(self):
+        return self.first_name + " " + self.last_name
+
+    def __repr__(self):
+        return "User(%r, %r)" % (self.id, self.name)
@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+import shutil
+import sys
+import threading
+import time
+
+FRAME_INTERVAL = 0.05  # seconds, at most one repaint per interval
+
+
+class Screen:
+    """
+    Keep the last painted frame and rewrite only lines that changed
+
+    frame is painted from the top-left corner, cursor is left on the line
+    right after the frame (where user input is echoed); everything below
+    the frame is cleared on every paint
+    """
+
+    def __init__(self, clear, out=None):
+        self.clear = clear
+        self.out = out
+        self.prev = None
+
+    def invalidate(self):
+        """next paint redraws everything (terminal content is unknown)"""
+        self.prev = None
+
+    def _fits(self, lines):
+        columns, rows = shutil.get_terminal_size()
+        # +1 line for input echo, wrapped or scrolled lines break positions
+        return len(lines) + 1 < rows and all(len(line) < columns for line in lines)
+
+    def paint(self, text):
+        out = self.out or sys.stdout
+        lines = text.split("\n")
+        if lines and lines[-1] == "":
+            lines.pop()
+        if self.prev is None or not self._fits(lines):
+            self.clear()
+            out.write("\n".join(lines) + "\n")
+            out.flush()
+            self.prev = lines
+            return
+        chunks = []
+        for row, line in enumerate(lines):
+            if row >= len(self.prev) or self.prev[row] != line:
+                # move to row, write line, erase rest of it
+                chunks.append("\x1b[%d;1H%s\x1b[K" % (row + 1, line))
+        # cursor after the frame, drop old tail and input echo
+        chunks.append("\x1b[%d;1H\x1b[J" % (len(lines) + 1))
+        out.write("".join(chunks))
+        out.flush()
+        self.prev = lines
+
+
+class RedrawScheduler:
+    """
+    Coalesce redraw requests from event handlers
+
+    request() is cheap and can be called for every event, draw() runs in own
+    daemon thread, not more often than once per interval
+    """
+
+    def __init__(self, draw, interval=FRAME_INTERVAL, on_error=None):
+        self.draw = draw
+        self.interval = interval
+        self.on_error = on_error
+        self._event = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="redraw")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def request(self):
+        self._event.set()
+
+    def _run(self):
+        last = 0.0
+        while 1:
+            self._event.wait()
+            delay = last + self.interval - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)  # collect the rest of the burst
+            self._event.clear()
+            try:
+                self.draw()
+            except Exception as e:
+                if self.on_error:
+                    self.on_error(e)
+            last = time.monotonic()
@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+import queue
+import threading
+import time
+from collections import deque
+from random import randint, uniform
+
+SEND_RETRIES = 5
+SEND_BACKOFF_BASE = 0.5  # seconds, doubled on every retry
+SEND_BACKOFF_MAX = 30.0
+# unknown error, too many requests per second, flood control, internal error
+TRANSIENT_ERRORS = {1, 6, 9, 10}
+SEEN_LIMIT = 1000  # outgoing message ids from long pool to match late responses
+
+QUEUED = "queued"
+SENDING = "sending"
+SENT = "sent"  # api accepted it, waiting for long pool event
+DELIVERED = "delivered"
+FAILED = "failed"
+
+
+class PendingMessage:
+    """handle of message in SendQueue, state changes as message is sent"""
+
+    __slots__ = ("peer_id", "body", "random_id", "state", "m_id", "error", "attempts")
+
+    def __init__(self, peer_id, body):
+        self.peer_id = peer_id
+        self.body = body
+        # same random_id on every retry, vk drops duplicates
+        self.random_id = randint(1, 2**31 - 1)
+        self.state = QUEUED
+        self.m_id = None
+        self.error = None
+        self.attempts = 0
+
+    def __repr__(self):
+        return "PendingMessage(%r, %r, %s)" % (self.peer_id, self.body, self.state)
+
+
+class SendQueue:
+    """
+    Outbound messages, sent one after another by own daemon thread
+
+    put() returns PendingMessage at once; transient api and network errors
+    are retried with jittered exponential backoff; message becomes DELIVERED
+    when long pool reports it (acknowledge(m_id))
+
+    send(peer_id, body, random_id) -> (success, message_id or error)
+    on_update() - called when state of any message changes
+    """
+
+    def __init__(self, send, on_update=None, retries=SEND_RETRIES):
+        self.send = send
+        self.on_update = on_update
+        self.retries = retries
+        self.queue = queue.Queue()
+        self.messages = []  # not delivered ones, in put order
+        self.by_m_id = {}
+        self.seen = deque(maxlen=SEEN_LIMIT)
+        self.lock = threading.Lock()
+        self._thread = threading.Thread(target=self._run, name="send-queue")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def put(self, peer_id, body):
+        msg = PendingMessage(peer_id, body)
+        with self.lock:
+            self.messages.append(msg)
+        self.queue.put(msg)
+        return msg
+
+    def pending(self, peer_id):
+        """not yet delivered messages of peer"""
+        with self.lock:
+            return [msg for msg in self.messages if msg.peer_id == peer_id]
+
+    def acknowledge(self, m_id):
+        """long pool got outgoing message m_id, return True if it was ours"""
+        with self.lock:
+            msg = self.by_m_id.pop(m_id, None)
+            if msg is None:
+                self.seen.append(m_id)  # response may come after the event
+                return False
+            self._delivered(msg)
+        self._notify()
+        return True
+
+    def _delivered(self, msg):
+        # under lock
+        msg.state = DELIVERED
+        self.messages.remove(msg)
+
+    def _notify(self):
+        if self.on_update:
+            self.on_update()
+
+    def _backoff(self, attempt):
+        time.sleep(uniform(0, min(SEND_BACKOFF_MAX, SEND_BACKOFF_BASE * 2**attempt)))
+
+    def _run(self):
+        import requests  # not at startup, it is slow to import
+
+        while 1:
+            msg = self.queue.get()
+            msg.state = SENDING
+            self._notify()
+            while 1:
+                msg.attempts += 1
+                try:
+                    success, res = self.send(msg.peer_id, msg.body, msg.random_id)
+                except requests.RequestException as e:
+                    success, res = False, {"error_code": 0, "error_msg": str(e)}
+                except Exception as e:  # bad response, sender thread must live
+                    success, res = False, {"error_code": -1, "error_msg": repr(e)}
+                if success:
+                    with self.lock:
+                        msg.m_id = res
+                        msg.state = SENT
+                        if res in self.seen:
+                            self._delivered(msg)
+                        else:
+                            self.by_m_id[res] = msg
+                    break
+                transient = res.get("error_code", 0) in TRANSIENT_ERRORS | {0}
+                if not transient or msg.attempts > self.retries:
+                    msg.state = FAILED
+                    msg.error = res
+                    break
+                self._backoff(msg.attempts - 1)
+            self._notify()
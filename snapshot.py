@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+"""
+Versioned immutable state of an account
+
+readers (pages, daemon api) take `status.snapshot` once and use only it,
+without locks; writers (long pool handlers, workers) change a Draft inside
+`with status.writing() as draft:`, on exit it becomes the next snapshot by
+one reference assignment, so readers see all changes of a write or none
+"""
+
+from collections import namedtuple
+from contextlib import contextmanager
+from threading import RLock
+from types import MappingProxyType
+
+# messages: {peer_id: tuple of Message}, chronological
+# titles: {peer_id: title} of chats and groups
+# typing: {peer_id: (user_id, monotonic time of typing event)}
+# dialogs_count: total on server, getConversations `count`
+# mappings are read-only, Message objects in them are never changed
+Snapshot = namedtuple("Snapshot", "version messages titles typing dialogs_count")
+
+
+def empty_snapshot():
+    return Snapshot(
+        0, MappingProxyType({}), MappingProxyType({}), MappingProxyType({}), 0
+    )
+
+
+class Draft:
+    """changes for the next snapshot, mappings are copied on first use"""
+
+    def __init__(self, base):
+        self.base = base
+        self.dialogs_count = base.dialogs_count
+        self._copies = {}
+
+    def _copy(self, name):
+        copy = self._copies.get(name)
+        if copy is None:
+            copy = self._copies[name] = dict(getattr(self.base, name))
+        return copy
+
+    @property
+    def messages(self):
+        return self._copy("messages")
+
+    @property
+    def titles(self):
+        return self._copy("titles")
+
+    @property
+    def typing(self):
+        return self._copy("typing")
+
+    def snapshot(self):
+        if not self._copies and self.dialogs_count == self.base.dialogs_count:
+            return self.base
+        return self.base._replace(
+            version=self.base.version + 1,
+            dialogs_count=self.dialogs_count,
+            **{name: MappingProxyType(copy) for name, copy in self._copies.items()}
+        )
+
+
+class Published:
+    """
+    Holder of the current Snapshot
+
+    writers are serialized by write_lock, nested writing() in the same thread
+    joins the outer one (all events of a long pool response are published
+    together)
+    """
+
+    def __init__(self):
+        self.snapshot = empty_snapshot()
+        self.write_lock = RLock()
+        self._draft = None
+
+    @property
+    def version(self):
+        return self.snapshot.version
+
+    @contextmanager
+    def writing(self):
+        with self.write_lock:
+            if self._draft is not None:
+                yield self._draft
+                return
+            self._draft = Draft(self.snapshot)
+            try:
+                yield self._draft
+            finally:
+                draft, self._draft = self._draft, None
+                # changes made before an error are consistent too
+                self.snapshot = draft.snapshot()
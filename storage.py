@@ -0,0 +1,226 @@
+# -*- coding: utf-8 -*-
+import json
+import sqlite3
+import threading
+
+from records import Message, User
+
+STORE_PATH = "messages.db"
+SEARCH_LIMIT = 20
+SNIPPET_TOKENS = 8  # words around match in search results
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS messages (
+    peer_id INTEGER NOT NULL,
+    m_id INTEGER NOT NULL,
+    out INTEGER NOT NULL,
+    timestamp INTEGER NOT NULL,
+    body TEXT NOT NULL,
+    read_state INTEGER,
+    fwd INTEGER NOT NULL DEFAULT 0,
+    sticker INTEGER,
+    attachments TEXT,
+    PRIMARY KEY (peer_id, m_id)
+);
+CREATE TABLE IF NOT EXISTS users (
+    id INTEGER PRIMARY KEY,
+    first_name TEXT NOT NULL,
+    last_name TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS cursor (
+    name TEXT PRIMARY KEY,
+    value INTEGER
+);
+"""
+# full-text index over bodies, rowid is message id (unique within account)
+FTS_SCHEMA = """
+CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5(
+    body,
+    peer_id UNINDEXED,
+    tokenize = 'unicode61 remove_diacritics 2'
+);
+"""
+
+
+def _fts_query(query):
+    """user text -> fts5 query: every word as quoted prefix, all must match"""
+    return " ".join('"%s"*' % word.replace('"', '""') for word in query.split())
+
+
+def _message_to_row(peer_id, msg):
+    return (
+        peer_id,
+        msg.m_id,
+        msg.out,
+        msg.timestamp,
+        msg.body,
+        msg.read_state,
+        1 if msg.fwd else 0,
+        msg.sticker,
+        json.dumps(msg.attachments) if msg.attachments else None,
+    )
+
+
+def _row_to_message(row):
+    _, m_id, out, timestamp, body, read_state, fwd, sticker, attachments = row
+    return Message(
+        m_id,
+        out,
+        timestamp,
+        body,
+        read_state,
+        bool(fwd),
+        sticker,
+        tuple(json.loads(attachments)) if attachments else (),
+    )
+
+
+class MessageStore:
+    """
+    On-disk cache of messages, user profiles and long pool cursor (ts, pts)
+
+    one sqlite connection shared between threads, every call holds the lock
+    """
+
+    def __init__(self, path=STORE_PATH):
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        with self.lock, self.db:
+            self.db.executescript(SCHEMA)
+            self.fts = self._create_fts()
+
+    def _create_fts(self):
+        """False if sqlite is built without fts5, search falls back to LIKE"""
+        try:
+            exists = self.db.execute(
+                "SELECT 1 FROM sqlite_master WHERE name = 'messages_fts'"
+            ).fetchone()
+            self.db.executescript(FTS_SCHEMA)
+        except sqlite3.OperationalError:
+            return False
+        if not exists:  # db of older version, index what is already stored
+            self.db.execute(
+                "INSERT INTO messages_fts (rowid, body, peer_id) "
+                "SELECT m_id, body, peer_id FROM messages"
+            )
+        return True
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+    def save_messages(self, peer_id, messages):
+        rows = [_message_to_row(peer_id, msg) for msg in messages]
+        if not rows:
+            return
+        with self.lock, self.db:
+            self.db.executemany(
+                "INSERT OR REPLACE INTO messages VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                rows,
+            )
+            if self.fts:
+                self.db.executemany(
+                    "INSERT OR REPLACE INTO messages_fts (rowid, body, peer_id) "
+                    "VALUES (?, ?, ?)",
+                    [(row[1], row[4], peer_id) for row in rows],
+                )
+
+    def delete_message(self, peer_id, m_id):
+        """forget deleted message, search index included"""
+        with self.lock, self.db:
+            self.db.execute(
+                "DELETE FROM messages WHERE peer_id = ? AND m_id = ?", (peer_id, m_id)
+            )
+            if self.fts:
+                self.db.execute("DELETE FROM messages_fts WHERE rowid = ?", (m_id,))
+
+    def update_body(self, peer_id, m_id, body, sticker=None, attachments=()):
+        """edited message, nothing is done if it is not stored"""
+        with self.lock, self.db:
+            updated = self.db.execute(
+                "UPDATE messages SET body = ?, sticker = ?, attachments = ? "
+                "WHERE peer_id = ? AND m_id = ?",
+                (
+                    body,
+                    sticker,
+                    json.dumps(attachments) if attachments else None,
+                    peer_id,
+                    m_id,
+                ),
+            ).rowcount
+            if updated and self.fts:
+                self.db.execute(
+                    "INSERT OR REPLACE INTO messages_fts (rowid, body, peer_id) "
+                    "VALUES (?, ?, ?)",
+                    (m_id, body, peer_id),
+                )
+
+    def search(self, query, limit=SEARCH_LIMIT):
+        """
+        [(peer_id, Message, snippet), ...] best matches first, across all chats
+        every word of query must match (as prefix), snippet has matches in []
+        """
+        if not query.split():
+            return []
+        with self.lock:
+            if self.fts:
+                rows = self.db.execute(
+                    "SELECT m.*, snippet(messages_fts, 0, '[', ']', '...', ?) "
+                    "FROM messages_fts AS f JOIN messages AS m "
+                    "ON m.peer_id = f.peer_id AND m.m_id = f.rowid "
+                    "WHERE messages_fts MATCH ? ORDER BY f.rank LIMIT ?",
+                    (SNIPPET_TOKENS, _fts_query(query), limit),
+                ).fetchall()
+            else:
+                words = query.split()
+                rows = self.db.execute(
+                    "SELECT *, body FROM messages WHERE "
+                    + " AND ".join(["body LIKE ?"] * len(words))
+                    + " ORDER BY m_id DESC LIMIT ?",
+                    ["%%%s%%" % word for word in words] + [limit],
+                ).fetchall()
+        return [(row[0], _row_to_message(row[:-1]), row[-1]) for row in rows]
+
+    def load_messages(self, peer_id, limit):
+        """last `limit` messages of peer, chronological order"""
+        with self.lock:
+            rows = self.db.execute(
+                "SELECT * FROM messages WHERE peer_id = ? ORDER BY m_id DESC LIMIT ?",
+                (peer_id, limit),
+            ).fetchall()
+        return [_row_to_message(row) for row in reversed(rows)]
+
+    def load_recent(self, limit):
+        """{peer_id: last `limit` messages} for every stored peer"""
+        with self.lock:
+            peer_ids = [
+                row[0]
+                for row in self.db.execute("SELECT DISTINCT peer_id FROM messages")
+            ]
+        return {peer_id: self.load_messages(peer_id, limit) for peer_id in peer_ids}
+
+    def save_users(self, users):
+        rows = [(u.id, u.first_name, u.last_name) for u in users]
+        if not rows:
+            return
+        with self.lock, self.db:
+            self.db.executemany("INSERT OR REPLACE INTO users VALUES (?, ?, ?)", rows)
+
+    def load_users(self):
+        """{id: User}"""
+        with self.lock:
+            rows = self.db.execute("SELECT id, first_name, last_name FROM users")
+            return {row[0]: User(*row) for row in rows}
+
+    def get_cursor(self):
+        """(ts, pts), None for unknown values"""
+        with self.lock:
+            values = dict(self.db.execute("SELECT name, value FROM cursor"))
+        return values.get("ts"), values.get("pts")
+
+    def set_cursor(self, ts=None, pts=None):
+        rows = [(name, value) for name, value in (("ts", ts), ("pts", pts)) if value]
+        if not rows:
+            return
+        with self.lock, self.db:
+            self.db.executemany("INSERT OR REPLACE INTO cursor VALUES (?, ?)", rows)
@@ -2,18 +2,172 @@
 import collections
 import json
 import sys
+import threading
 import time
-from random import randint
+from random import randint, uniform
+from urllib.parse import quote
 
-import requests
+from jsonstream import STREAMING, ItemStream, loads, parse_items
+from metrics import Metrics
+
+API_POOL_SIZE = 4
+LONG_POOL_POOL_SIZE = 1
+API_TIMEOUT = 10
+API_URL = "https://api.vk.com/method/"
+LONG_POOL_SCHEME = "https"  # long pool `server` comes without scheme
+RATE_LIMIT = 3  # requests per RATE_PERIOD, vk allows 3 per second for user tokens
+RATE_PERIOD = 1.0
+EXECUTE_LIMIT = 25  # max api calls inside one `execute`
+LONG_POOL_BACKOFF_BASE = 1.0  # seconds, doubled on every failed retry
+LONG_POOL_BACKOFF_MAX = 60.0
+
+
+def _version_key(version):
+    return tuple(map(int, str(version).split(".")))
+
+
+class TokenBucket:
+    """
+    Thread-safe token bucket
+    holds one token, refilled continuously at rate/period per second, so calls
+    are spaced by period/rate: a bigger bucket would let a caller back from idle
+    burst over the server limit (3 + 3 calls in one second);
+    acquire() only sleeps when the bucket is empty
+    """
+
+    def __init__(self, rate=RATE_LIMIT, period=RATE_PERIOD):
+        self.rate = rate
+        self.period = period
+        self.capacity = 1.0
+        self.fill_rate = rate / period
+        self.tokens = self.capacity
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _refill(self, now):
+        self.tokens = min(
+            self.capacity, self.tokens + (now - self.last) * self.fill_rate
+        )
+        self.last = now
+
+    def set_rate(self, rate, period):
+        """change limit, tokens taken before are kept"""
+        with self.lock:
+            self._refill(time.monotonic())
+            self.rate = rate
+            self.period = period
+            self.fill_rate = rate / period
+
+    def acquire(self):
+        """take one token, return time spent waiting"""
+        waited = 0.0
+        while 1:
+            with self.lock:
+                now = time.monotonic()
+                self._refill(now)
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return waited
+                delay = (1 - self.tokens) / self.fill_rate
+            time.sleep(delay)
+            waited += delay
+
+
+class BatchCall:
+    """single call collected by RequestBatch, `result` is (success, res) after flush"""
+
+    def __init__(self, method, params):
+        self.method = method
+        self.params = params
+        self.result = None
+
+
+class RequestBatch:
+    """
+    Collect api calls and send them as `execute` requests, EXECUTE_LIMIT per request
+
+    with vk.batch() as batch:
+        call = batch.add('messages.getHistory', {'peer_id': 1, 'count': 10})
+    success, res = call.result
+    """
+
+    def __init__(self, vk):
+        self.vk = vk
+        self.calls = []
+
+    def add(self, method, params={}):
+        call = BatchCall(method, dict(params))
+        self.calls.append(call)
+        if len(self.calls) >= EXECUTE_LIMIT:
+            self.flush()
+        return call
+
+    def flush(self):
+        calls, self.calls = self.calls, []
+        for start in range(0, len(calls), EXECUTE_LIMIT):
+            self.vk.execute_calls(calls[start : start + EXECUTE_LIMIT])
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.flush()
 
 
 class VK_api:
-    def __init__(self, token, long_pool={}, logger=None):
+    # one bucket per token: every VK_api instance with the same token
+    # shares the same budget
+    _buckets = {}
+    _buckets_lock = threading.Lock()
+
+    def __init__(
+        self,
+        token,
+        long_pool={},
+        logger=None,
+        api_pool_size=API_POOL_SIZE,
+        long_pool_pool_size=LONG_POOL_POOL_SIZE,
+        api_timeout=API_TIMEOUT,
+        rate_limit=RATE_LIMIT,
+        rate_period=RATE_PERIOD,
+        api_url=API_URL,
+        long_pool_scheme=LONG_POOL_SCHEME,
+        metrics=None,
+        connect=True,
+    ):
         self.token = token
+        self.metrics = metrics if metrics is not None else Metrics()
+        self.metrics.describe(
+            "vk_api_request_seconds", "api method call, request and json parsing"
+        )
+        self.metrics.describe(
+            "vk_rate_limit_wait_seconds", "time api calls slept in rate limiter"
+        )
+        self.metrics.describe(
+            "vk_long_pool_seconds", "get_long_pool call, including retries"
+        )
+        self.api_url = api_url
+        self.long_pool_scheme = long_pool_scheme
         self.logger = logger
+        self.rate_limiter = self._get_bucket(token, rate_limit, rate_period)
+        self.api_timeout = api_timeout
+        # keep-alive sessions: one for method calls, one for long pool,
+        # so a hanging long pool request never holds an api connection;
+        # made on first request, so requests is imported only then
+        self.pool_sizes = {"api": api_pool_size, "long_pool": long_pool_pool_size}
+        self._sessions = {}
+        self._sessions_lock = threading.Lock()
+        self.long_pool_stats = {
+            "reconnects": 0,  # retries after network errors or broken responses
+            "ts_resyncs": 0,  # failed: 1
+            "key_refreshes": 0,  # failed: 2, 3
+            "disconnected_time": 0.0,  # seconds without a successful response
+        }
         if long_pool and all((val != "" for val in long_pool.values())):
             self.long_pool_config = long_pool
+        elif not connect:  # loaded by first get_long_pool, in its thread
+            self.long_pool_config = {}
         else:
             self.long_pool_config = self._get_long_pool_config()
             if not self.long_pool_config:
@@ -21,6 +175,49 @@ class VK_api:
                 raise SystemExit(-1)
             self.logged_add("long pool loaded successfully")
 
+    @staticmethod
+    def _make_session(pool_size):
+        import requests
+        from requests.adapters import HTTPAdapter
+
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        return session
+
+    @classmethod
+    def _get_bucket(cls, token, rate, period):
+        with cls._buckets_lock:
+            bucket = cls._buckets.get(token)
+            if bucket is None:
+                bucket = cls._buckets[token] = TokenBucket(rate, period)
+            elif (bucket.rate, bucket.period) != (rate, period):
+                bucket.set_rate(rate, period)  # the last created VK_api sets it
+            return bucket
+
+    def _session(self, name):
+        session = self._sessions.get(name)
+        if session is not None:
+            return session
+        with self._sessions_lock:
+            if name not in self._sessions:
+                self._sessions[name] = self._make_session(self.pool_sizes[name])
+            return self._sessions[name]
+
+    @property
+    def api_session(self):
+        return self._session("api")
+
+    @property
+    def long_pool_session(self):
+        return self._session("long_pool")
+
+    def close(self):
+        with self._sessions_lock:
+            for session in self._sessions.values():
+                session.close()
+
     def logged_add(self, msg):
         if self.logger:
             self.logger.add(msg)
@@ -28,7 +225,7 @@ class VK_api:
     def _get_long_pool_str(self, config=None):
         if config is None:
             config = {}
-        _long_pool_str = "https://{server}?act=a_check&"
+        _long_pool_str = self.long_pool_scheme + "://{server}?act=a_check&"
         # key={key}
         # ts={ts}
         # mode={mode}
@@ -37,7 +234,8 @@ class VK_api:
             config["mode"] = 1
         if not "wait" in config:
             config["wait"] = 25
-        config.update(self.long_pool_config)
+        # pts is a cursor for getLongPollHistory, a_check does not need it
+        config.update((k, v) for k, v in self.long_pool_config.items() if k != "pts")
 
         if (
             "server" in config
@@ -50,73 +248,234 @@ class VK_api:
             return _long_pool_str + "&".join(
                 ["%s=%s" % (k, v) for k, v in config.items()]
             )
+        return None  # config is incomplete, should be reloaded
+
+    def connect(self):
+        """load long pool server config, return True on success"""
         self.long_pool_config = self._get_long_pool_config()
-        return self._get_long_pool_str(config)
+        return bool(self.long_pool_config)
 
     def _get_long_pool_config(self):
-        # res = self.api_request('messages.getLongPollServer',{'need_pts':1,})
-        res = self.api_request("messages.getLongPollServer", {"v": 5.4})
+        from requests import RequestException
+
+        try:
+            res = self.api_request(
+                "messages.getLongPollServer", {"need_pts": 1, "v": 5.4}
+            )
+        except (RequestException, ValueError) as e:
+            self.logged_add("error getLongPollServer: %s" % e)
+            return {}
         if "error" in res:
             self.logged_add("error getLongPollServer: %s" % res["error"])
-            time.sleep(0.5)
             return {}
         return res["response"]
 
+    def _method_url(self, method, params):
+        return "%s%s?access_token=%s&%s" % (
+            self.api_url,
+            method,
+            self.token,
+            # values are quoted: message texts and execute code have & # +
+            "&".join(["%s=%s" % (k, quote(str(v))) for k, v in params.items()]),
+        )
+
+    def _observe_response(self, method, start, res):
+        self.metrics.observe(
+            "vk_api_request_seconds", time.perf_counter() - start, method=method
+        )
+        if "error" in res:
+            self.metrics.inc(
+                "vk_api_errors_total",
+                method=method,
+                code=res["error"].get("error_code", 0),
+            )
+
     def api_request(self, method, params={}):
-        time.sleep(0.5)  # ограничение
-        return json.loads(
+        waited = self.rate_limiter.acquire()  # ограничение
+        self.metrics.observe("vk_rate_limit_wait_seconds", waited)
+        start = time.perf_counter()
+        res = loads(
             self.request(
-                "https://api.vk.com/method/%s?access_token=%s&%s"
-                % (
-                    method,
-                    self.token,
-                    "&".join(["%s=%s" % (k, v) for k, v in params.items()]),
-                )
+                self._method_url(method, params), {"timeout": self.api_timeout}
             )
         )
+        self._observe_response(method, start, res)
+        return res
 
-    def request(self, url, params={}):
-        res = requests.get(url, **params)
-        return res.content.decode("utf-8")
+    def api_request_items(self, method, params={}, path="items"):
+        """
+        api_request for responses with big arrays (history):
+        (True, ItemStream) - items of response[path] (dotted) one by one,
+        stream.rest is response without them; (False, error)
+        with ijson items are parsed while read from network, no full copy of
+        response is held; connection is busy until stream is exhausted or closed
+        """
+        waited = self.rate_limiter.acquire()
+        self.metrics.observe("vk_rate_limit_wait_seconds", waited)
+        start = time.perf_counter()
+        res = self.api_session.get(
+            self._method_url(method, params), timeout=self.api_timeout, stream=True
+        )
+        try:
+            if STREAMING:
+                res.raw.decode_content = True  # gzip
+                doc, items = parse_items(res.raw, "response." + path)
+            else:
+                doc, items = parse_items(res.content, "response." + path)
+        except BaseException:  # bad json, network error
+            res.close()
+            raise
+        if not isinstance(doc, dict):  # empty body, html of proxy, ...
+            doc = {"error": {"error_code": 0, "error_msg": "bad response: %r" % doc}}
+        if "error" in doc or "response" not in doc:
+            res.close()
+            self._observe_response(method, start, doc)
+            return (False, doc.get("error", doc))
+
+        def close():
+            res.close()
+            self._observe_response(method, start, doc)
+
+        return (True, ItemStream(items, doc["response"], close))
+
+    def batch(self):
+        return RequestBatch(self)
+
+    def execute_calls(self, calls):
+        """
+        send up to EXECUTE_LIMIT calls as one `execute`, fill call.result for each
+        execute has a single api version, the newest one among calls is used
+        """
+        if not calls:
+            return
+        version = "5.52"
+        code = []
+        for call in calls:
+            params = dict(call.params)
+            version = max(version, str(params.pop("v", version)), key=_version_key)
+            code.append("API.%s(%s)" % (call.method, json.dumps(params)))
+        res = self.api_request(
+            "execute",
+            {"code": "return [%s];" % ",".join(code), "v": version},
+        )
+        if "error" in res:
+            for call in calls:
+                call.result = (False, res["error"])
+            return
+        # failed calls return `false`, their errors go to execute_errors in order
+        errors = iter(res.get("execute_errors", []))
+        responses = res.get("response")
+        if not isinstance(responses, list):
+            responses = []
+        for call, call_res in zip(calls, responses):
+            if call_res is False:
+                call.result = (False, next(errors, {"error_msg": "execute failed"}))
+            else:
+                call.result = (True, call_res)
+        # short response: execute stopped (limits) before these calls
+        for call in calls[len(responses) :]:
+            call.result = (False, {"error_code": 0, "error_msg": "no execute response"})
+
+    def request(self, url, params={}, session=None):
+        if session is None:
+            session = self.api_session
+        res = session.get(url, **params)
+        return res.content  # bytes, json is parsed from them without decoding
+
+    def _long_pool_request(self, config):
+        """single long pool request, None on network error or broken response"""
+        from requests import RequestException
 
-    def get_long_pool(self, config={}):
-        """get_long_pool(config={})"""
         url = self._get_long_pool_str(config)
-        res = {}
+        if url is None:
+            return {"failed": 2}
         timeout = 30
         if "timeout" in config:
             timeout = config["timeout"] + 5
-        res_ = self.request(url, {"timeout": timeout})
         try:
-            res = json.loads(res_)
+            res_ = self.request(url, {"timeout": timeout}, self.long_pool_session)
+        except RequestException as e:
+            self.logged_add("long pool request failed: %s" % e)
+            return None
+        try:
+            return loads(res_)
         except ValueError:
-            print("failed load this json:", res_, sep="\n", flush=True)
-            res = {"failed": 2}  # let us reload
-        # res = json.loads(self.request(url))
-        if "failed" in res:
-            self.logged_add("some fail with long pool server: %s" % res)
-            if res["failed"] == 1:
+            self.logged_add("failed load long pool json: %r" % res_[:100])
+            return None
+
+    def _backoff(self, attempt):
+        """full jitter: uniform(0, min(max, base * 2**attempt))"""
+        time.sleep(
+            uniform(0, min(LONG_POOL_BACKOFF_MAX, LONG_POOL_BACKOFF_BASE * 2**attempt))
+        )
+
+    def get_long_pool(self, config={}):
+        """
+        get_long_pool(config={})
+        retry until server returns updates:
+        failed 1 - only ts is outdated, retry at once with new ts
+        failed 2, 3 - key expired or data lost, reload server config and retry
+        network errors and broken responses - retry with jittered exponential backoff
+        """
+        if not self.long_pool_config:  # VK_api(connect=False)
+            self.connect()
+        attempt = 0
+        disconnected_since = None
+        start = time.perf_counter()
+        while 1:
+            res = self._long_pool_request(dict(config))
+            if res is not None and "failed" not in res:
+                if disconnected_since is not None:
+                    self.long_pool_stats["disconnected_time"] += (
+                        time.monotonic() - disconnected_since
+                    )
                 self.long_pool_config["ts"] = res["ts"]
-            if res["failed"] == 2 or res["failed"] == 3:
-                self.long_pool_config = self._get_long_pool_config()
-            time.sleep(2)  # lets wait for 2 sec
-            return self.get_long_pool()
-        self.long_pool_config["ts"] = res["ts"]
-        return res
+                if "pts" in res:  # mode 32
+                    self.long_pool_config["pts"] = res["pts"]
+                self.metrics.observe(
+                    "vk_long_pool_seconds", time.perf_counter() - start
+                )
+                return res
+
+            if res is not None and res["failed"] == 1:
+                self.long_pool_stats["ts_resyncs"] += 1
+                self.long_pool_config["ts"] = res["ts"]
+                continue
 
-    def message__send(self, peer_id: int, msg: str):
+            if disconnected_since is None:
+                disconnected_since = time.monotonic()
+            if res is not None:  # failed 2, 3
+                self.logged_add("some fail with long pool server: %s" % res)
+                self.long_pool_stats["key_refreshes"] += 1
+                long_pool_config = self._get_long_pool_config()
+                if long_pool_config:
+                    self.long_pool_config = long_pool_config
+                    if attempt == 0:  # fresh key, no reason to wait
+                        attempt += 1
+                        continue
+            self.long_pool_stats["reconnects"] += 1
+            self._backoff(attempt)
+            attempt += 1
+
+    def message__send(self, peer_id: int, msg: str, random_id=None):
+        """
+        (True, message_id) on success
+        random_id: pass the same value on retries, vk sends message only once
+        """
+        if random_id is None:
+            random_id = randint(1, 2**31 - 1)
         res = self.api_request(
             "messages.send",
             {
                 "peer_id": peer_id,
                 "message": msg,
                 "v": "5.53",
-                "random_id": randint(0, 65535),
+                "random_id": random_id,
             },
         )
         if "error" in res:
             return (False, res["error"])
-        return (True, res)
+        return (True, res["response"])
 
     def messages__send(self, peer_id_and_msg: list):
         resend = []
@@ -126,7 +485,6 @@ class VK_api:
                 self.logged_add("some error while send message: %s" % res)
                 resend.append((id, msg))
         if not resend:
-            time.sleep(0.3)
             return (True, None)
         return (False, resend)
 
@@ -156,24 +514,101 @@ class VK_api:
             return (False, res["error"])
         return (True, res["response"])
 
-    def messages__getHistory(self, peer_id, count, rev=0):
+    def messages__getHistory(
+        self, peer_id, count, rev=0, offset=None, start_message_id=None
+    ):
         """
         rev: 1 - return in chronologic order, 0 - reverse
+        offset: skip messages, may be negative with start_message_id (newer ones)
+        start_message_id: count offset from this message instead of the last one
+        """
+        params = {"peer_id": peer_id, "count": count, "rev": rev, "v": "5.52"}
+        if offset is not None:
+            params["offset"] = offset
+        if start_message_id is not None:
+            params["start_message_id"] = start_message_id
+        res = self.api_request("messages.getHistory", params)
+        if "error" in res:
+            return (False, res["error"])
+        return (True, res["response"])
+
+    def messages__getHistory_iter(
+        self, peer_id, count, rev=0, offset=None, start_message_id=None
+    ):
+        """messages__getHistory, (True, ItemStream of messages) on success"""
+        params = {"peer_id": peer_id, "count": count, "rev": rev, "v": "5.52"}
+        if offset is not None:
+            params["offset"] = offset
+        if start_message_id is not None:
+            params["start_message_id"] = start_message_id
+        return self.api_request_items("messages.getHistory", params)
+
+    def messages__getById(self, message_ids):
+        """(True, [message object, ...]), attachments have full metadata"""
+        res = self.api_request(
+            "messages.getById",
+            {"message_ids": ",".join(map(str, message_ids)), "v": "5.52"},
+        )
+        if "error" in res:
+            return (False, res["error"])
+        return (True, res["response"]["items"])
+
+    def messages__getHistory_many(self, peer_ids, count, rev=0):
+        """{peer_id: (success, res)}, batched through execute"""
+        with self.batch() as batch:
+            calls = {
+                peer_id: batch.add(
+                    "messages.getHistory",
+                    {"peer_id": peer_id, "count": count, "rev": rev, "v": "5.52"},
+                )
+                for peer_id in peer_ids
+            }
+        return {peer_id: call.result for peer_id, call in calls.items()}
+
+    def messages__getConversations(self, offset=0, count=200):
+        """
+        dialogs ordered by last message, with profiles and groups of peers
+        (getConversations exists since 5.80, its messages have `text`, not `body`)
         """
         res = self.api_request(
-            "messages.getHistory",
-            {"peer_id": peer_id, "count": count, "rev": rev, "v": "5.52"},
+            "messages.getConversations",
+            {"offset": offset, "count": count, "extended": 1, "v": "5.80"},
         )
         if "error" in res:
             return (False, res["error"])
         return (True, res["response"])
 
-    def users__get(self, user_ids=[]):
+    def messages__getLongPollHistory(self, ts, pts, max_msg_id=None):
+        """events and messages since (ts, pts), response has new_pts and `more`"""
+        params = {"ts": ts, "pts": pts, "v": "5.52"}
+        if max_msg_id is not None:
+            params["max_msg_id"] = max_msg_id
+        res = self.api_request("messages.getLongPollHistory", params)
+        if "error" in res:
+            return (False, res["error"])
+        return (True, res["response"])
+
+    def messages__getLongPollHistory_iter(self, ts, pts, max_msg_id=None):
+        """
+        messages__getLongPollHistory, (True, ItemStream of messages) on success
+        new_pts and `more` are in stream.rest after messages are read
+        """
+        params = {"ts": ts, "pts": pts, "v": "5.52"}
+        if max_msg_id is not None:
+            params["max_msg_id"] = max_msg_id
+        return self.api_request_items(
+            "messages.getLongPollHistory", params, "messages.items"
+        )
+
+    def users__get(self, user_ids=[], fields=None):
         if hasattr(user_ids, "__iter__") and not isinstance(user_ids, str):
             user_ids = ",".join(map(str, user_ids))
         else:
             user_ids = str(user_ids)
-        res = self.api_request("users.get", {"user_ids": user_ids, "v": "5.52"})
+        params = {"user_ids": user_ids, "v": "5.52"}
+        if fields:
+            params["fields"] = fields
+        res = self.api_request("users.get", params)
         if "error" in res:
             return (False, res["error"])
         return (True, res["response"])
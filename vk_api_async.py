@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+import asyncio
+
+from vk_api import VK_api
+from workers import FOREGROUND, WorkerPool
+
+EXECUTOR_WORKERS = 4
+
+
+def _async_method(name):
+    async def method(self, *args, **kwargs):
+        return await self._call(getattr(self.vk, name), *args, **kwargs)
+
+    method.__name__ = name
+    method.__doc__ = "async version of VK_api.%s" % name
+    return method
+
+
+class AsyncVK_api:
+    """
+    asyncio front-end for VK_api
+
+    blocking http calls run in a small bounded pool, so any number of
+    coroutines share VK_api's connection pools and rate limiter without
+    starting a thread per request; pool threads are daemons, exit never
+    waits for a hanging request
+    """
+
+    def __init__(self, vk: VK_api, loop, max_workers=EXECUTOR_WORKERS):
+        self.vk = vk
+        self.loop = loop
+        # long pool holds its worker for up to `wait` seconds, keep it apart
+        # so it can not starve method calls
+        self.executor = WorkerPool(max_workers, name="async-api")
+        self.long_pool_executor = WorkerPool(1, name="async-long-pool")
+
+    def _wrap(self, future):
+        return asyncio.wrap_future(future, loop=self.loop)
+
+    async def _call(self, func, *args, **kwargs):
+        return await self._wrap(self.executor.submit(FOREGROUND, func, *args, **kwargs))
+
+    async def get_long_pool(self, config={}):
+        return await self._wrap(
+            self.long_pool_executor.submit(FOREGROUND, self.vk.get_long_pool, config)
+        )
+
+    def close(self):
+        self.vk.close()
+
+    api_request = _async_method("api_request")
+    execute_calls = _async_method("execute_calls")
+    message__send = _async_method("message__send")
+    messages__send = _async_method("messages__send")
+    messages__mark_as_read = _async_method("messages__mark_as_read")
+    account_setOnline = _async_method("account_setOnline")
+    messages__getLastActivity = _async_method("messages__getLastActivity")
+    messages__getById = _async_method("messages__getById")
+    messages__getHistory = _async_method("messages__getHistory")
+    messages__getHistory_many = _async_method("messages__getHistory_many")
+    users__get = _async_method("users__get")
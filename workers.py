@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+import itertools
+import queue
+import threading
+from concurrent.futures import Future
+
+WORKERS = 3  # more threads than rate limit allows is useless
+
+# lower runs first
+FOREGROUND = 0  # user is waiting for it (opened chat)
+PREFETCH = 5  # data for pages user may open next
+BACKGROUND = 10  # mark as read and other fire-and-forget work
+
+
+class WorkerPool:
+    """
+    Bounded pool of daemon threads fed from a priority queue
+
+    submit() returns concurrent.futures.Future,
+    tasks with the same priority run in submit order
+    """
+
+    def __init__(self, workers=WORKERS, name="worker"):
+        self._queue = queue.PriorityQueue()
+        self._counter = itertools.count()
+        self._lock = threading.Lock()
+        self._in_flight = 0
+        self._threads = []
+        for i in range(workers):
+            t = threading.Thread(target=self._work, name="%s-%d" % (name, i))
+            t.daemon = True
+            t.start()
+            self._threads.append(t)
+
+    def submit(self, priority, func, *args, **kwargs):
+        future = Future()
+        self._queue.put((priority, next(self._counter), future, func, args, kwargs))
+        return future
+
+    @property
+    def queue_depth(self):
+        return self._queue.qsize()
+
+    @property
+    def in_flight(self):
+        return self._in_flight
+
+    def stats(self):
+        return {
+            "workers": len(self._threads),
+            "queue_depth": self.queue_depth,
+            "in_flight": self.in_flight,
+        }
+
+    def _work(self):
+        while 1:
+            _, _, future, func, args, kwargs = self._queue.get()
+            if not future.set_running_or_notify_cancel():
+                continue
+            with self._lock:
+                self._in_flight += 1
+            try:
+                future.set_result(func(*args, **kwargs))
+            except BaseException as e:
+                future.set_exception(e)
+            finally:
+                with self._lock:
+                    self._in_flight -= 1